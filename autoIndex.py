@@ -0,0 +1,119 @@
+import numpy as np
+import time
+from kdTree import KDTree
+from brute import BruteForceSearch
+
+class AutoIndex:
+
+    # Front end that answers queries with whichever of KDTree and
+    # BruteForceSearch is cheaper.  On construction both engines run a short
+    # batched kNN benchmark on jittered data points at two batch sizes, which
+    # fits a cost of overhead + per_query * m for each engine, and the tree's
+    # single-point search is timed on its own.  Every query batch then goes
+    # to the engine with the lower predicted cost, and the tree is dropped
+    # altogether when it never wins for this dataset.
+
+    def __init__(self, points, ids=None, leaf_size=16, calibration_queries=128, calibration_k=10,
+                 calibrate=True, seed=0, metric=None):
+        if not isinstance(points, np.ndarray):
+            points = np.array(points)
+
+        self.points = points
+        self.brute = BruteForceSearch(points, ids=ids, metric=metric)
+        self.tree = KDTree(points, leaf_size=leaf_size, ids=ids, metric=metric) if len(points) else None
+        # engine name -> (overhead seconds, seconds per query); 'kdtree_single'
+        # is the tree's single-point search, which has no batch overhead
+        self.costs = {}
+
+        if calibrate and self.tree is not None:
+            self._calibrate(calibration_queries, calibration_k, np.random.default_rng(seed))
+            # Costs are linear in m, so the tree never wins if it loses both
+            # for a single query and per query in the limit
+            tree_overhead, tree_per_query = self.costs['kdtree']
+            brute_overhead, brute_per_query = self.costs['brute']
+            single = self.costs['kdtree_single'][1]
+            if tree_per_query >= brute_per_query and \
+               min(tree_overhead + tree_per_query, single) >= brute_overhead + brute_per_query:
+                self.tree = None
+
+    def _time_batch(self, engine, X, k, repeats=3):
+        # Best of a few runs; slow runs are not repeated to bound start-up time
+        best = float('inf')
+        for _ in range(repeats):
+            start_time = time.perf_counter()
+            engine.query(X, k)
+            best = min(best, time.perf_counter() - start_time)
+            if best > 0.1:
+                break
+        return best
+
+    def _calibrate(self, m, k, rng):
+        # Queries shaped like the data: sampled points nudged by a fraction
+        # of the per-axis spread
+        rows = rng.integers(0, len(self.points), size=m)
+        spread = np.std(self.points, axis=0)
+        X = self.points[rows] + rng.normal(scale=0.05, size=(m, self.points.shape[1])) * spread
+        k = min(k, len(self.points))
+
+        small = max(1, m // 8)
+        brute_large = None  # brute force's time on the whole batch
+        for name, engine in (('brute', self.brute), ('kdtree', self.tree)):
+            engine.query(X[:small], k)  # warm up
+            t_small = self._time_batch(engine, X[:small], k)
+            if name == 'kdtree' and t_small > brute_large:
+                # Slower on the small batch than brute force on the large
+                # one: the tree loses by a wide margin, no need to time more
+                self.costs[name] = (0.0, t_small / small)
+                break
+            t_large = self._time_batch(engine, X, k)
+            if name == 'brute':
+                brute_large = t_large
+            per_query = max((t_large - t_small) / (m - small), 0.0) if m > small else t_large / m
+            overhead = max(t_small - per_query * small, 0.0)
+            self.costs[name] = (overhead, per_query)
+
+        # A few single-point searches are enough to price the tree's single path
+        single = X[:min(small, 8)]
+        start_time = time.perf_counter()
+        for query_point in single:
+            self.tree.k_nearest_neighbors(query_point, k)
+        self.costs['kdtree_single'] = (0.0, (time.perf_counter() - start_time) / len(single))
+
+    def engine_for(self, m, single=False):
+        # Name of the engine predicted to answer m queries fastest, either as
+        # one batch or, with single, through the single-point methods
+        if self.tree is None:
+            return 'brute'
+        if not self.costs:
+            return 'kdtree'
+        tree = self.costs['kdtree_single'] if single else self.costs['kdtree']
+        tree_cost = tree[0] + tree[1] * m
+        brute_cost = self.costs['brute'][0] + self.costs['brute'][1] * m
+        return 'kdtree' if tree_cost <= brute_cost else 'brute'
+
+    def _engine(self, m, single=False):
+        return self.tree if self.engine_for(m, single) == 'kdtree' else self.brute
+
+    def query(self, X, k=1):
+        if not isinstance(X, np.ndarray):
+            X = np.array(X)
+        return self._engine(len(np.atleast_2d(X))).query(X, k)
+
+    def query_ball_point(self, X, r):
+        if not isinstance(X, np.ndarray):
+            X = np.array(X)
+        return self._engine(len(np.atleast_2d(X))).query_ball_point(X, r)
+
+    def query_range(self, lower_bounds, upper_bounds):
+        if not isinstance(lower_bounds, np.ndarray):
+            lower_bounds = np.array(lower_bounds)
+        return self._engine(len(np.atleast_2d(lower_bounds))).query_range(lower_bounds, upper_bounds)
+
+    def nearest_neighbor(self, query_point, return_points=False):
+        return self._engine(1, single=True).nearest_neighbor(query_point, return_points=return_points)
+
+    def k_nearest_neighbors(self, query_point, k=1, return_points=False):
+        return self._engine(1, single=True).k_nearest_neighbors(query_point, k, return_points=return_points)
+
+    def range_search(self, lower_bound, upper_bound, return_points=False):
+        return self._engine(1, single=True).range_search(lower_bound, upper_bound, return_points=return_points)
@@ -0,0 +1,254 @@
+import numpy as np
+import argparse
+import itertools
+import json
+import platform
+import sys
+import time
+from kdTree import KDTree
+from brute import BruteForceSearch
+
+# Benchmark suite for the search engines.  Every combination of dataset
+# size, dimension, distribution, leaf size, k and selectivity is built once
+# per engine and each operation is timed with perf_counter after warmup
+# runs, over several repeats.  Correctness checks run outside the timed
+# loops.  Results are written as JSON with latency percentiles so that runs
+# can be diffed for regressions.
+
+DISTRIBUTIONS = ('uniform', 'clustered', 'duplicates', 'lowdim')
+OPERATIONS = ('knn', 'knn_batch', 'knn_approx', 'range', 'ball')
+ENGINES = ('kdtree', 'brute')
+PERCENTILES = (50, 90, 99)
+
+def make_data(distribution, n, d, rng):
+    # n points in [0, 1)^d-ish space shaped like one of DISTRIBUTIONS
+    if distribution == 'uniform':
+        return rng.random((n, d))
+    if distribution == 'clustered':
+        # Gaussian blobs of very different sizes around random centres
+        n_clusters = max(1, min(50, n // 200))
+        centres = rng.random((n_clusters, d))
+        sizes = rng.dirichlet(np.full(n_clusters, 0.5))
+        labels = rng.choice(n_clusters, size=n, p=sizes)
+        return centres[labels] + rng.normal(scale=0.02, size=(n, d))
+    if distribution == 'duplicates':
+        # Every point repeats one of n // 20 distinct ones
+        distinct = rng.random((max(1, n // 20), d))
+        return distinct[rng.integers(0, len(distinct), size=n)]
+    if distribution == 'lowdim':
+        # A 2-dimensional sheet embedded in d dimensions, with a little noise
+        intrinsic = min(2, d)
+        basis = rng.normal(size=(intrinsic, d))
+        return rng.random((n, intrinsic)) @ basis + rng.normal(scale=1e-3, size=(n, d))
+    raise ValueError(f"Unknown distribution {distribution!r}")
+
+def make_queries(points, m, rng):
+    # Queries shaped like the data: sampled points nudged by a fraction of
+    # the per-axis spread
+    rows = rng.integers(0, len(points), size=m)
+    spread = np.std(points, axis=0)
+    return points[rows] + rng.normal(scale=0.05, size=(m, points.shape[1])) * spread
+
+def _between(distances, count):
+    # Size halfway between the count-th and the next nearest distance, so
+    # that no point sits on the boundary where rounding decides whether it
+    # is inside; ties (or no next point) get a small relative margin
+    inner = distances[:, count - 1]
+    if distances.shape[1] == count:
+        return inner * (1 + 1e-9)
+    outer = distances[:, count]
+    return np.where(outer > inner, (inner + outer) / 2, inner * (1 + 1e-9))
+
+def selectivity_sizes(points, queries, selectivity):
+    # Per-query half-width of a range box and radius of a ball that each
+    # hold about selectivity * n points, from the Chebyshev and Euclidean
+    # distances to the matching nearest neighbour
+    count = int(min(len(points), max(1, round(selectivity * len(points)))))
+    neighbours = min(len(points), count + 1)
+    chebyshev, _ = BruteForceSearch(points, metric='chebyshev').query(queries, neighbours)
+    euclidean, _ = BruteForceSearch(points).query(queries, neighbours)
+    return _between(chebyshev, count), _between(np.sqrt(euclidean), count)
+
+def summarize(samples):
+    # Latency statistics in seconds
+    samples = np.asarray(samples, dtype=np.float64)
+    summary = {f'p{q}': float(np.percentile(samples, q)) for q in PERCENTILES}
+    summary.update(mean=float(samples.mean()), min=float(samples.min()), max=float(samples.max()),
+                   samples=len(samples))
+    return summary
+
+def time_calls(func, calls, warmup, repeats):
+    # Seconds per call of func(*args) for every args in calls, repeated;
+    # the warmup rounds run the first calls and are not recorded
+    for args in calls[:warmup]:
+        func(*args)
+    samples = []
+    for _ in range(repeats):
+        for args in calls:
+            start_time = time.perf_counter()
+            func(*args)
+            samples.append(time.perf_counter() - start_time)
+    return samples
+
+def build_engine(engine, points, leaf_size):
+    if engine == 'kdtree':
+        return KDTree(points, leaf_size=leaf_size)
+    if engine == 'brute':
+        return BruteForceSearch(points)
+    raise ValueError(f"Unknown engine {engine!r}")
+
+def approximate_recall(index, queries, k, eps, max_checks, exact_d):
+    # Mean fraction of the true k nearest neighbours found by the
+    # best-bin-first search.  With ties the neighbour sets are ambiguous, so
+    # a result counts when it is no further than the true k-th neighbour.
+    found = []
+    for q, kth in zip(queries, exact_d[:, -1]):
+        nearest, _ = index.k_nearest_neighbors(q, k, eps=eps, max_checks=max_checks)
+        found.append(min(k, sum(dist <= kth * (1 + 1e-9) for _, dist in nearest)))
+    return float(np.mean(found) / k)
+
+def _same_sets(a, b):
+    return all(np.array_equal(np.sort(x), np.sort(y)) for x, y in zip(a, b))
+
+def verify(index, reference, queries, k, half_widths, radii):
+    # Whether index answers every operation like brute force (ties among
+    # equal distances make the kNN check compare distances, not indices)
+    d, _ = index.query(queries, k)
+    ref_d, _ = reference.query(queries, k)
+    ranges = [index.range_search(q - h, q + h)[0] for q, h in zip(queries, half_widths)]
+    ref_ranges = [reference.range_search(q - h, q + h)[0] for q, h in zip(queries, half_widths)]
+    balls = index.query_ball_point(queries, radii)
+    ref_balls = reference.query_ball_point(queries, radii)
+    return {
+        'knn': bool(np.allclose(d, ref_d)),
+        'range': _same_sets(ranges, ref_ranges),
+        'ball': _same_sets(balls, ref_balls),
+    }
+
+def run_case(engine, points, queries, leaf_size, k, half_widths, radii, operations, warmup, repeats,
+             eps=0.0, max_checks=512):
+    # Build time and per-operation latencies of one engine on one dataset;
+    # knn_approx also reports its recall and only runs on the KDTree
+    start_time = time.perf_counter()
+    index = build_engine(engine, points, leaf_size)
+    build_seconds = time.perf_counter() - start_time
+
+    single = [(q,) for q in queries]
+    boxes = [(q - h, q + h) for q, h in zip(queries, half_widths)]
+    results = {}
+    for operation in operations:
+        if operation == 'knn_approx' and engine != 'kdtree':
+            continue
+        if operation == 'knn':
+            samples = time_calls(lambda q: index.k_nearest_neighbors(q, k), single, warmup, repeats)
+            per_query = samples
+        elif operation == 'knn_approx':
+            samples = time_calls(lambda q: index.k_nearest_neighbors(q, k, eps=eps, max_checks=max_checks),
+                                 single, warmup, repeats)
+            per_query = samples
+        elif operation == 'knn_batch':
+            samples = time_calls(lambda X: index.query(X, k), [(queries,)], warmup, repeats)
+            per_query = [s / len(queries) for s in samples]
+        elif operation == 'range':
+            samples = time_calls(index.range_search, boxes, warmup, repeats)
+            per_query = samples
+        elif operation == 'ball':
+            samples = time_calls(lambda X: index.query_ball_point(X, radii), [(queries,)], warmup, repeats)
+            per_query = [s / len(queries) for s in samples]
+        else:
+            raise ValueError(f"Unknown operation {operation!r}")
+        results[operation] = {
+            'latency': summarize(samples),
+            'per_query': summarize(per_query),
+            'queries_per_second': float(len(per_query) / np.sum(per_query)),
+        }
+        if operation == 'knn_approx':
+            exact_d, _ = BruteForceSearch(points).query(queries, k)
+            results[operation].update(eps=eps, max_checks=max_checks,
+                                      recall=approximate_recall(index, queries, k, eps, max_checks, exact_d))
+    return index, build_seconds, results
+
+def run_benchmark(sizes=(10000,), dims=(3,), ks=(10,), leaf_sizes=(16,), distributions=('uniform',),
+                  selectivities=(1e-3,), engines=ENGINES, operations=OPERATIONS, queries=100,
+                  warmup=3, repeats=5, check=False, seed=0, eps=0.0, max_checks=512):
+    # One record per (configuration, engine), in sweep order
+    records = []
+    for n, d, distribution in itertools.product(sizes, dims, distributions):
+        rng = np.random.default_rng(seed)
+        points = make_data(distribution, n, d, rng)
+        X = make_queries(points, queries, rng)
+        reference = BruteForceSearch(points) if check else None
+        for selectivity, k, leaf_size in itertools.product(selectivities, ks, leaf_sizes):
+            half_widths, radii = selectivity_sizes(points, X, selectivity)
+            for engine in engines:
+                # Leaf size means nothing to brute force: run it once
+                if engine == 'brute' and leaf_size != leaf_sizes[0]:
+                    continue
+                index, build_seconds, results = run_case(engine, points, X, leaf_size, k, half_widths, radii,
+                                                         operations, warmup, repeats, eps, max_checks)
+                record = {
+                    'engine': engine, 'n': n, 'd': d, 'distribution': distribution, 'k': k,
+                    'leaf_size': leaf_size if engine == 'kdtree' else None, 'selectivity': selectivity,
+                    'queries': queries, 'build_seconds': build_seconds, 'operations': results,
+                }
+                if check:
+                    record['correct'] = verify(index, reference, X, k, half_widths, radii)
+                records.append(record)
+    return records
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }
+
+def print_summary(records, file=sys.stderr):
+    # One line per engine and operation with the median per-query latency
+    for record in records:
+        config = (f"{record['engine']:>6} n={record['n']} d={record['d']} {record['distribution']} "
+                  f"k={record['k']} leaf={record['leaf_size']} sel={record['selectivity']:g}")
+        for operation, result in record['operations'].items():
+            p50 = result['per_query']['p50'] * 1e6
+            recall = f", recall {result['recall']:.3f}" if 'recall' in result else ""
+            print(f"{config} {operation:>10}: p50 {p50:10.1f} us/query{recall}", file=file)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark KDTree against brute force search.")
+    parser.add_argument('--n', type=int, nargs='+', default=[10000], help="dataset sizes")
+    parser.add_argument('--d', type=int, nargs='+', default=[3], help="dimensions")
+    parser.add_argument('--k', type=int, nargs='+', default=[10], help="neighbours per kNN query")
+    parser.add_argument('--leaf-size', type=int, nargs='+', default=[16], help="KDTree leaf sizes")
+    parser.add_argument('--distribution', nargs='+', default=['uniform'], choices=DISTRIBUTIONS)
+    parser.add_argument('--selectivity', type=float, nargs='+', default=[1e-3],
+                        help="fraction of the points matched by range and ball queries")
+    parser.add_argument('--engine', nargs='+', default=list(ENGINES), choices=ENGINES)
+    parser.add_argument('--operation', nargs='+', default=list(OPERATIONS), choices=OPERATIONS)
+    parser.add_argument('--eps', type=float, default=0.0, help="knn_approx: allowed relative distance error")
+    parser.add_argument('--max-checks', type=int, default=512, help="knn_approx: points scanned per query")
+    parser.add_argument('--queries', type=int, default=100, help="queries per configuration")
+    parser.add_argument('--warmup', type=int, default=3, help="untimed calls before measuring")
+    parser.add_argument('--repeats', type=int, default=5, help="timed passes over the queries")
+    parser.add_argument('--check', action='store_true', help="verify results against brute force")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='-', help="JSON file to write ('-' for stdout)")
+    args = parser.parse_args(argv)
+
+    records = run_benchmark(sizes=args.n, dims=args.d, ks=args.k, leaf_sizes=args.leaf_size,
+                            distributions=args.distribution, selectivities=args.selectivity,
+                            engines=args.engine, operations=args.operation, queries=args.queries,
+                            warmup=args.warmup, repeats=args.repeats, check=args.check, seed=args.seed,
+                            eps=args.eps, max_checks=args.max_checks)
+    report = {'environment': environment(), 'config': vars(args), 'results': records}
+    print_summary(records)
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
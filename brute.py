@@ -1,66 +1,256 @@
 import numpy as np
 import time
-from myTime import time_decorator
+from myTime import time_decorator, count
+from metrics import Cosine, get_metric
 
 class BruteForceSearch:
-    
-    def __init__(self, points):
+
+    # Exhaustive search over distance blocks computed as |q|^2 + |p|^2 - 2 q.p,
+    # so the inner loop is a matrix product.  Blocks hold at most block_size
+    # entries, which bounds memory for any number of points and queries.
+    # Because the expansion loses precision, selected neighbours get their
+    # distances recomputed exactly and radius matches are re-checked.  Other
+    # metrics than (unweighted) L2 have no such expansion and fill the
+    # blocks axis by axis instead.  Points keep their dtype, and blocks are
+    # computed in the metric's dtype.
+
+    def __init__(self, points, ids=None, block_size=2**22, metric=None):
         if not isinstance(points, np.ndarray):
             points = np.array(points)
+        self.metric = get_metric(metric)
+        points = self.metric.prepare(points)
         self.points = points
-    
+        # Optional payload id per input row, reported instead of the row index
+        if ids is not None:
+            ids = np.asarray(ids)
+            if len(ids) != len(points):
+                raise ValueError("ids must have one entry per point")
+        self.ids = ids
+        self.block_size = block_size
+        self.sq_norms = np.einsum('ij,ij->i', points, points, dtype=np.float64) if len(points) else np.zeros(0)
+
+    def _label(self, index):
+        if self.ids is None:
+            return index
+        if np.ndim(index) == 0:
+            return -1 if index == -1 else self.ids[index]
+        labels = self.ids[np.maximum(index, 0)]
+        missing = index == -1
+        if missing.any():
+            # Signed and float ids take the -1 padding in their own dtype;
+            # any other kind of id needs an object array to hold it
+            if labels.dtype.kind in 'if':
+                labels[missing] = -1
+            else:
+                labels = labels.astype(object)
+                labels[missing] = -1
+        return labels
+
+    def _metric(self, metric):
+        # Metric of one query: the index's own unless another one is given
+        if metric is None:
+            return self.metric
+        metric = get_metric(metric)
+        if isinstance(metric, Cosine) != isinstance(self.metric, Cosine):
+            raise ValueError("The cosine metric must be chosen when the index is built")
+        return metric
+
+    def _expands(self, metric):
+        # Whether the matrix product form applies (cosine is plain L2 on the
+        # normalized points)
+        return metric.p == 2 and metric.weights is None
+
+    def _blocks(self, m):
+        # Query rows and point columns per distance block
+        n = len(self.points)
+        cols = max(1, min(n, self.block_size))
+        rows = max(1, self.block_size // cols)
+        for q_lo in range(0, m, rows):
+            q_hi = min(q_lo + rows, m)
+            for p_lo in range(0, n, cols):
+                yield q_lo, q_hi, p_lo, min(p_lo + cols, n)
+
+    def _block_distances(self, X, x_norms, p_lo, p_hi, metric):
+        if not self._expands(metric):
+            return metric.block(X, self.points[p_lo:p_hi])
+        sq_norms = self.sq_norms[None, p_lo:p_hi].astype(metric.dtype, copy=False)
+        distances = x_norms[:, None] + sq_norms - 2.0 * (X @ self.points[p_lo:p_hi].T)
+        return np.maximum(distances, 0.0, out=distances)
+
+    def _exact_distances(self, X, index, metric):
+        # Reduced distances from each row of X to the points in the same row
+        # of index (-1 entries come back as inf), a block of at most
+        # block_size coordinates at a time
+        distances = np.empty(index.shape, dtype=metric.dtype)
+        rows = max(1, self.block_size // max(1, index.shape[1] * X.shape[1]))
+        for lo in range(0, len(X), rows):
+            distances[lo:lo + rows] = metric.reduced(X[lo:lo + rows, None, :] - self.points[np.maximum(index[lo:lo + rows], 0)])
+        distances[index == -1] = np.inf
+        return distances
+
+    def _query(self, X, k, metric):
+        m = len(X)
+        x_norms = np.einsum('ij,ij->i', X, X)
+        best_d = np.full((m, k), np.inf, dtype=metric.dtype)
+        best_i = np.full((m, k), -1, dtype=np.intp)
+        if len(self.points) == 0:
+            return best_d, best_i
+
+        missing = np.iinfo(np.intp).max
+        for q_lo, q_hi, p_lo, p_hi in self._blocks(m):
+            distances = self._block_distances(X[q_lo:q_hi], x_norms[q_lo:q_hi], p_lo, p_hi, metric)
+            index = np.broadcast_to(np.arange(p_lo, p_hi), distances.shape)
+            # Merge this block's candidates with the running k best
+            cand_d = np.concatenate((best_d[q_lo:q_hi], distances), axis=1)
+            cand_i = np.concatenate((best_i[q_lo:q_hi], index), axis=1)
+            keep = np.argpartition(cand_d, k - 1, axis=1)[:, :k]
+            best_d[q_lo:q_hi] = np.take_along_axis(cand_d, keep, axis=1)
+            best_i[q_lo:q_hi] = np.take_along_axis(cand_i, keep, axis=1)
+            if p_hi < len(self.points):
+                continue
+
+            # Every point has been seen by these rows: exact distances for
+            # their winners; sorting by index before the stable sort by
+            # distance keeps the lower index first on ties
+            rows_i = np.sort(np.where(best_i[q_lo:q_hi] == -1, missing, best_i[q_lo:q_hi]), axis=1)
+            rows_i[rows_i == missing] = -1
+            rows_d = self._exact_distances(X[q_lo:q_hi], rows_i, metric)
+            order = np.argsort(rows_d, axis=1, kind='stable')
+            best_d[q_lo:q_hi] = np.take_along_axis(rows_d, order, axis=1)
+            best_i[q_lo:q_hi] = np.take_along_axis(rows_i, order, axis=1)
+        return best_d, best_i
+
+    @time_decorator
+    def query(self, X, k=1, metric=None):
+        if not isinstance(X, np.ndarray):
+            X = np.array(X)
+        single = X.ndim == 1
+        metric = self._metric(metric)
+        X = metric.prepare_queries(np.atleast_2d(X))
+
+        best_d, best_i = self._query(X, k, metric)
+        count('BruteForceSearch.query', distance_evaluations=len(X) * len(self.points),
+              results=int(np.count_nonzero(best_i != -1)))
+        best_i = self._label(best_i)
+        if single:
+            return best_d[0], best_i[0]
+        return best_d, best_i
+
+    def _group_pairs(self, m, query_parts, id_parts):
+        # Turn (query, point index) pairs into one index array per query
+        if not query_parts:
+            return [np.empty(0, dtype=np.intp) for _ in range(m)]
+        queries = np.concatenate(query_parts)
+        index = np.concatenate(id_parts)
+        order = np.argsort(queries, kind='stable')
+        splits = np.searchsorted(queries[order], np.arange(1, m))
+        return np.split(index[order], splits)
+
     @time_decorator
-    def nearest_neighbor(self, query_point):
+    def query_ball_point(self, X, r, metric=None):
+        # r is a true distance, not a reduced one
+        if not isinstance(X, np.ndarray):
+            X = np.array(X)
+        single = X.ndim == 1
+        metric = self._metric(metric)
+        X = metric.prepare_queries(np.atleast_2d(X))
+
+        m = len(X)
+        radius = np.broadcast_to(metric.from_distance(np.asarray(r, dtype=np.float64)), (m,))
+        x_norms = np.einsum('ij,ij->i', X, X)
+        expands = self._expands(metric)
+        query_parts, id_parts = [], []
+
+        for q_lo, q_hi, p_lo, p_hi in self._blocks(m):
+            distances = self._block_distances(X[q_lo:q_hi], x_norms[q_lo:q_hi], p_lo, p_hi, metric)
+            if not expands:
+                rows, cols = np.nonzero(distances <= radius[q_lo:q_hi, None])
+                query_parts.append(rows + q_lo)
+                id_parts.append(cols + p_lo)
+                continue
+            # Loose test on the expanded distances, then an exact re-check;
+            # the slack scales with the precision of the dtype
+            slack = np.sqrt(np.finfo(metric.dtype).eps) * (x_norms[q_lo:q_hi, None] + self.sq_norms[None, p_lo:p_hi])
+            rows, cols = np.nonzero(distances <= radius[q_lo:q_hi, None] + slack)
+            rows += q_lo
+            cols += p_lo
+            exact = metric.reduced(X[rows] - self.points[cols]) <= radius[rows]
+            query_parts.append(rows[exact])
+            id_parts.append(cols[exact])
+
+        count('BruteForceSearch.query_ball_point', distance_evaluations=m * len(self.points),
+              results=sum(len(part) for part in id_parts))
+        result = [self._label(part) for part in self._group_pairs(m, query_parts, id_parts)]
+        return result[0] if single else result
+
+    @time_decorator
+    def query_range(self, lower_bounds, upper_bounds):
+        if not isinstance(lower_bounds, np.ndarray):
+            lower_bounds = np.array(lower_bounds)
+        if not isinstance(upper_bounds, np.ndarray):
+            upper_bounds = np.array(upper_bounds)
+        single = lower_bounds.ndim == 1
+        lower_bounds = np.atleast_2d(lower_bounds)
+        upper_bounds = np.atleast_2d(upper_bounds)
+        if not np.all(lower_bounds <= upper_bounds):
+            raise ValueError("Invalid range: lower_bound must be less than or equal to upper_bound in all dimensions")
+
+        result = [self._label(part) for part in self._query_range(lower_bounds, upper_bounds)]
+        return result[0] if single else result
+
+    def _query_range(self, lower_bounds, upper_bounds):
+        m = len(lower_bounds)
+        query_parts, id_parts = [], []
+        for q_lo, q_hi, p_lo, p_hi in self._blocks(m):
+            points = self.points[p_lo:p_hi]
+            inside = np.ones((q_hi - q_lo, p_hi - p_lo), dtype=bool)
+            for axis in range(points.shape[1]):
+                inside &= lower_bounds[q_lo:q_hi, axis, None] <= points[None, :, axis]
+                inside &= points[None, :, axis] <= upper_bounds[q_lo:q_hi, axis, None]
+            rows, cols = np.nonzero(inside)
+            query_parts.append(rows + q_lo)
+            id_parts.append(cols + p_lo)
+
+        return self._group_pairs(m, query_parts, id_parts)
+
+    @time_decorator
+    def nearest_neighbor(self, query_point, return_points=False, metric=None):
         if not isinstance(query_point, np.ndarray):
             query_point = np.array(query_point)
-            
-        min_dist = float('inf')
-        nearest_point = None
-        
-        for point in self.points:
-            dist = np.sum((query_point - point) ** 2)
-            if dist < min_dist:
-                min_dist = dist
-                nearest_point = point
-                
-        return (nearest_point, min_dist), []
-    
+        if len(self.points) == 0:
+            return (None, float('inf')), []
+        metric = self._metric(metric)
+
+        distances, index = self._query(metric.prepare_queries(query_point[None, :]), 1, metric)
+        if return_points:
+            return (self.points[index[0, 0]], distances[0, 0]), []
+        return (self._label(index[0, 0]), distances[0, 0]), []
+
     @time_decorator
-    def k_nearest_neighbors(self, query_point, k=1):
+    def k_nearest_neighbors(self, query_point, k=1, return_points=False, metric=None):
         if not isinstance(query_point, np.ndarray):
             query_point = np.array(query_point)
-            
-        # Initialize with k infinity distances
-        k_nearest = [(float('inf'), None) for _ in range(k)]
-        
-        for point in self.points:
-            dist = np.sum((query_point - point) ** 2)
-            
-            # If current point is closer than the furthest in k_nearest
-            if dist < k_nearest[-1][0]:
-                # Find the correct position to insert
-                for i in range(k):
-                    if dist < k_nearest[i][0]:
-                        # Shift elements to make space
-                        k_nearest[i+1:] = k_nearest[i:-1]
-                        # Insert new point
-                        k_nearest[i] = (dist, tuple(point))
-                        break
-        
-        # Convert to list of (point, distance) pairs
-        result = [(point, dist) for dist, point in k_nearest if point is not None]
+        metric = self._metric(metric)
+
+        distances, index = self._query(metric.prepare_queries(query_point[None, :]), k, metric)
+        found = index[0] != -1
+        distances, index = distances[0, found], index[0, found]
+
+        # Convert to list of (index, distance) pairs
+        if return_points:
+            result = [(tuple(self.points[i]), d) for i, d in zip(index, distances)]
+        else:
+            result = list(zip(self._label(index), distances))
         return result, []
-    
+
     @time_decorator
-    def range_search(self, lower_bound, upper_bound):
+    def range_search(self, lower_bound, upper_bound, return_points=False):
         if not isinstance(lower_bound, np.ndarray):
             lower_bound = np.array(lower_bound)
         if not isinstance(upper_bound, np.ndarray):
             upper_bound = np.array(upper_bound)
-            
-        result = []
-        for point in self.points:
-            if np.all(lower_bound <= point) and np.all(point <= upper_bound):
-                result.append(point)
-                
-        return result, []
+
+        result = self._query_range(lower_bound[None, :], upper_bound[None, :])[0]
+        if return_points:
+            return list(self.points[result]), []
+        return self._label(result), []
@@ -0,0 +1,402 @@
+import numpy as np
+import heapq
+import json
+import os
+import shutil
+import threading
+from metrics import Cosine, get_metric
+from queryCache import QueryCache
+
+# Out-of-core KD-tree for point sets larger than RAM.  The points are
+# streamed from a memory-mapped .npy file and split externally: while a
+# partition holds more than memory_points points it is scanned in chunks of
+# chunk_points and written out to two temporary partition files on either
+# side of a sampled median.  Once a partition fits in memory it is split in
+# RAM down to leaf pages of at most page_points points, which are appended
+# to one pages file as (row, coordinates) records.  Only the upper tree
+# (split planes, node boxes, page extents) is kept in RAM when querying;
+# pages are read on demand through a bounded LRU buffer cache.  Results are
+# row indices into the .npy file and reduced distances, like KDTree.
+
+INDEX_FILE = 'index.json'
+NODES_FILE = 'nodes.npz'
+PAGES_FILE = 'pages.bin'
+DISK_FORMAT_VERSION = 1
+
+def _record_dtype(dtype, d):
+    return np.dtype([('id', '<i8'), ('x', dtype, (d,))])
+
+
+class _RowIds:
+
+    # Ids of rows start:stop of the input file, materialized only for the
+    # slices actually read
+
+    def __init__(self, start, stop):
+        self.start, self.stop = start, stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            rows = range(self.start, self.stop)[key]
+            return _RowIds(rows.start, rows.stop)
+        return np.asarray(key, dtype=np.int64) + self.start
+
+    def __array__(self, dtype=None, copy=None):
+        return np.arange(self.start, self.stop, dtype=dtype or np.int64)
+
+
+class _Builder:
+
+    # One build: node arrays grow in preorder while pages are written out
+
+    def __init__(self, directory, record, page_points, memory_points, chunk_points, sample_size, rng):
+        self.directory = directory
+        self.record = record
+        self.page_points = page_points
+        self.memory_points = memory_points
+        self.chunk_points = chunk_points
+        self.sample_size = sample_size
+        self.rng = rng
+        self.split_dims, self.split_values, self.left, self.right = [], [], [], []
+        self.mins, self.maxes, self.pages = [], [], []
+        self.page_start, self.page_end = [], []
+        self.n_written = 0
+        self.n_temp = 0
+        self.pages_file = open(os.path.join(directory, PAGES_FILE), 'wb')
+
+    def _new_node(self):
+        for array in (self.split_dims, self.split_values, self.mins, self.maxes):
+            array.append(None)
+        for array in (self.left, self.right, self.pages):
+            array.append(-1)
+        return len(self.left) - 1
+
+    def _finish_internal(self, node, axis, value, left, right):
+        self.split_dims[node] = axis
+        self.split_values[node] = float(value)
+        self.left[node], self.right[node] = left, right
+        self.mins[node] = np.minimum(self.mins[left], self.mins[right])
+        self.maxes[node] = np.maximum(self.maxes[left], self.maxes[right])
+
+    def _write_page(self, ids, coords):
+        node = self._new_node()
+        records = np.empty(len(ids), dtype=self.record)
+        records['id'] = ids
+        records['x'] = coords
+        records.tofile(self.pages_file)
+        self.pages[node] = len(self.page_start)
+        self.page_start.append(self.n_written)
+        self.n_written += len(ids)
+        self.page_end.append(self.n_written)
+        self.split_dims[node], self.split_values[node] = 0, 0.0
+        self.mins[node], self.maxes[node] = coords.min(axis=0), coords.max(axis=0)
+        return node
+
+    def build_memory(self, ids, coords):
+        # Split a partition that fits in RAM at its median, down to pages
+        if len(ids) <= self.page_points:
+            return self._write_page(ids, coords)
+        node = self._new_node()
+        axis = int(np.argmax(coords.max(axis=0) - coords.min(axis=0)))
+        mid = len(ids) // 2
+        order = np.argpartition(coords[:, axis], mid)
+        ids, coords = ids[order], coords[order]
+        left = self.build_memory(ids[:mid], coords[:mid])
+        right = self.build_memory(ids[mid:], coords[mid:])
+        self._finish_internal(node, axis, coords[mid, axis], left, right)
+        return node
+
+    def build(self, ids, coords, path=None):
+        # Subtree over a partition given as row ids and coordinates, both
+        # sliceable without loading them (memory maps or _RowIds), or read
+        # from the temporary partition file at path.  A partition file is
+        # removed as soon as it has been split, before its children are
+        # built, so the partitions on disk never hold more than one copy of
+        # the data.
+        if path is not None:
+            records = np.memmap(path, dtype=self.record, mode='r')
+            ids, coords = records['id'], records['x']
+            del records
+        count = len(coords)
+        if count <= self.memory_points:
+            ids, coords = np.array(ids, dtype=np.int64), np.array(coords)
+            if path is not None:
+                os.remove(path)
+            return self.build_memory(ids, coords)
+        node = self._new_node()
+
+        # Split axis and value from a sample: widest axis, median value
+        sample = coords[np.sort(self.rng.choice(count, size=min(self.sample_size, count), replace=False))]
+        axis = int(np.argmax(sample.max(axis=0) - sample.min(axis=0)))
+        value = np.median(sample[:, axis])
+
+        paths = [self._temp_path(), self._temp_path()]
+        counts = self._stream_split(ids, coords, axis, value, paths)
+        # A partition the sample could not split (e.g. all points on one
+        # side of the median) is split by position instead
+        if min(counts) == 0:
+            for child_path in paths:
+                os.remove(child_path)
+            # Halves in their current order; node boxes keep the searches
+            # exact whatever the split.  The partition file is read by both
+            # halves and goes once they are built.
+            half = count // 2
+            left = self.build(ids[:half], coords[:half])
+            right = self.build(ids[half:], coords[half:])
+            del ids, coords
+            if path is not None:
+                os.remove(path)
+            self._finish_internal(node, 0, self.mins[right][0], left, right)
+            return node
+
+        # Dropping the last views of the memory map frees the file's space
+        del ids, coords
+        if path is not None:
+            os.remove(path)
+        left, right = [self.build(None, None, child_path) for child_path in paths]
+        self._finish_internal(node, axis, value, left, right)
+        return node
+
+    def _stream_split(self, ids, coords, axis, value, paths):
+        # Stream a partition into two files and return their point counts;
+        # points equal to the split value fill the left side up to half, so
+        # duplicates stay balanced
+        counts = [0, 0]
+        half = len(coords) // 2
+        with open(paths[0], 'wb') as left_file, open(paths[1], 'wb') as right_file:
+            for lo in range(0, len(coords), self.chunk_points):
+                chunk_ids = np.asarray(ids[lo:lo + self.chunk_points], dtype=np.int64)
+                chunk = np.asarray(coords[lo:lo + self.chunk_points])
+                column = chunk[:, axis]
+                go_left = column < value
+                ties = np.flatnonzero(column == value)
+                go_left[ties[:max(0, half - counts[0] - int(np.count_nonzero(go_left)))]] = True
+                for side, mask, f in ((0, go_left, left_file), (1, ~go_left, right_file)):
+                    records = np.empty(int(np.count_nonzero(mask)), dtype=self.record)
+                    records['id'] = chunk_ids[mask]
+                    records['x'] = chunk[mask]
+                    records.tofile(f)
+                    counts[side] += len(records)
+        return counts
+
+    def _temp_path(self):
+        self.n_temp += 1
+        return os.path.join(self.directory, 'tmp', f'partition-{self.n_temp}.bin')
+
+    def close(self):
+        self.pages_file.close()
+
+
+class DiskKDTree:
+
+    def __init__(self, directory, cache_pages=256, cache_bytes=None):
+        # Open a tree written by DiskKDTree.build; at most cache_pages pages
+        # (and cache_bytes bytes, if given) are held in memory at once
+        with open(os.path.join(directory, INDEX_FILE)) as f:
+            header = json.load(f)
+        if header['version'] != DISK_FORMAT_VERSION:
+            raise ValueError(f"Unsupported disk KD-Tree version {header['version']}")
+        self.directory = directory
+        self.n = header['n']
+        self.k = header['k']
+        self.page_points = header['page_points']
+        self.metric = get_metric(header['metric'])
+        self.record = _record_dtype(np.dtype(header['dtype']), self.k)
+
+        with np.load(os.path.join(directory, NODES_FILE)) as nodes:
+            for name in ('split_dims', 'split_values', 'left', 'right', 'node_mins', 'node_maxes',
+                         'pages', 'page_start', 'page_end'):
+                setattr(self, name, nodes[name])
+        self.root = 0 if self.n else -1
+
+        self.page_cache = QueryCache(cache_pages, cache_bytes)
+        self.page_reads = 0
+        self._pages_file = open(os.path.join(directory, PAGES_FILE), 'rb')
+        self._lock = threading.Lock()
+
+    @classmethod
+    def build(cls, npy_path, directory, page_points=4096, memory_points=1 << 22, chunk_points=1 << 20,
+              sample_size=65536, metric=None, seed=0, cache_pages=256, cache_bytes=None):
+        # Build a tree over the points of a 2-D .npy file into directory and
+        # open it.  At most about memory_points points (plus one chunk) are
+        # held in memory.  Besides pages.bin, which holds every point as a
+        # record of its row id and coordinates, the temporary partition
+        # files take up to the size of those records again while building.
+        if page_points < 1 or memory_points < page_points:
+            raise ValueError("Need 1 <= page_points <= memory_points")
+        metric = get_metric(metric)
+        if isinstance(metric, Cosine):
+            raise ValueError("The cosine metric needs normalized points and is not supported out of core")
+        points = np.load(npy_path, mmap_mode='r')
+        if points.ndim != 2:
+            raise ValueError("The .npy file must hold a 2-D array of points")
+        n, k = points.shape
+
+        os.makedirs(os.path.join(directory, 'tmp'), exist_ok=True)
+        builder = _Builder(directory, _record_dtype(points.dtype, k), page_points, memory_points,
+                           chunk_points, sample_size, np.random.default_rng(seed))
+        try:
+            if n:
+                builder.build(_RowIds(0, n), points)
+        finally:
+            builder.close()
+            shutil.rmtree(os.path.join(directory, 'tmp'), ignore_errors=True)
+
+        empty = np.zeros((0, k), dtype=points.dtype)
+        np.savez(os.path.join(directory, NODES_FILE),
+                 split_dims=np.array(builder.split_dims, dtype=np.intp),
+                 split_values=np.array(builder.split_values, dtype=np.float64),
+                 left=np.array(builder.left, dtype=np.intp), right=np.array(builder.right, dtype=np.intp),
+                 node_mins=np.array(builder.mins) if n else empty,
+                 node_maxes=np.array(builder.maxes) if n else empty,
+                 pages=np.array(builder.pages, dtype=np.intp),
+                 page_start=np.array(builder.page_start, dtype=np.int64),
+                 page_end=np.array(builder.page_end, dtype=np.int64))
+        header = {'version': DISK_FORMAT_VERSION, 'n': n, 'k': k, 'dtype': points.dtype.str,
+                  'page_points': page_points, 'metric': metric.spec()}
+        with open(os.path.join(directory, INDEX_FILE), 'w') as f:
+            json.dump(header, f)
+        return cls(directory, cache_pages=cache_pages, cache_bytes=cache_bytes)
+
+    def close(self):
+        self._pages_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.n
+
+    def _metric(self, metric):
+        if metric is None:
+            return self.metric
+        metric = get_metric(metric)
+        if isinstance(metric, Cosine):
+            raise ValueError("The cosine metric is not supported out of core")
+        return metric
+
+    def _page(self, page):
+        # Row ids and coordinates of a page, through the buffer cache
+        hit, records = self.page_cache.get(page)
+        if not hit:
+            start, end = int(self.page_start[page]), int(self.page_end[page])
+            with self._lock:
+                self._pages_file.seek(start * self.record.itemsize)
+                data = self._pages_file.read((end - start) * self.record.itemsize)
+                self.page_reads += 1
+            records = np.frombuffer(data, dtype=self.record)
+            self.page_cache.put(page, records)
+        return records['id'], records['x']
+
+    def cache_info(self):
+        info = self.page_cache.info()
+        info['page_reads'] = self.page_reads
+        return info
+
+    def _box_lower(self, node, query_point, metric):
+        gap = np.maximum(np.maximum(self.node_mins[node] - query_point, query_point - self.node_maxes[node]), 0.0)
+        return float(metric.reduced(gap))
+
+    def _descend(self, X):
+        # Page node that each query point falls into
+        nodes = np.zeros(len(X), dtype=np.intp)
+        active = np.flatnonzero(self.left[nodes] != -1)
+        while len(active):
+            node = nodes[active]
+            go_left = X[active, self.split_dims[node]] < self.split_values[node]
+            nodes[active] = np.where(go_left, self.left[node], self.right[node])
+            active = active[self.left[nodes[active]] != -1]
+        return nodes
+
+    def _knn(self, query_point, k, metric):
+        # Best-first search over node boxes; pages are loaded only when
+        # their box is closer than the current k-th distance
+        best_d = np.full(k, np.inf, dtype=metric.dtype)
+        best_i = np.full(k, -1, dtype=np.int64)
+        kth = np.inf
+        heap = [(0.0, 0)]
+        while heap:
+            bound, node = heapq.heappop(heap)
+            if bound >= kth:
+                break
+            if self.left[node] == -1:
+                ids, coords = self._page(self.pages[node])
+                distances = metric.reduced(coords - query_point)
+                cand_d = np.concatenate((best_d, distances))
+                cand_i = np.concatenate((best_i, ids))
+                keep = np.argpartition(cand_d, k - 1)[:k]
+                best_d, best_i = cand_d[keep], cand_i[keep]
+                kth = best_d.max()
+                continue
+            for child in (self.left[node], self.right[node]):
+                child_bound = self._box_lower(child, query_point, metric)
+                if child_bound < kth:
+                    heapq.heappush(heap, (child_bound, child))
+        order = np.argsort(best_d, kind='stable')
+        return best_d[order], best_i[order]
+
+    def query(self, X, k=1, metric=None):
+        # (m, k) reduced distances and row ids, padded with inf / -1
+        if not isinstance(X, np.ndarray):
+            X = np.array(X)
+        single = X.ndim == 1
+        metric = self._metric(metric)
+        X = metric.prepare_queries(np.atleast_2d(X))
+
+        best_d = np.full((len(X), k), np.inf, dtype=metric.dtype)
+        best_i = np.full((len(X), k), -1, dtype=np.int64)
+        if self.root != -1:
+            # Queries falling into the same page run back to back, so the
+            # pages they share are read once
+            for row in np.argsort(self._descend(X), kind='stable'):
+                best_d[row], best_i[row] = self._knn(X[row], k, metric)
+        if single:
+            return best_d[0], best_i[0]
+        return best_d, best_i
+
+    def nearest_neighbor(self, query_point, metric=None):
+        if self.root == -1:
+            return (None, float('inf')), []
+        distances, ids = self.query(query_point, 1, metric)
+        return (ids[0], distances[0]), []
+
+    def k_nearest_neighbors(self, query_point, k=1, metric=None):
+        distances, ids = self.query(query_point, k, metric)
+        found = ids != -1
+        return list(zip(ids[found], distances[found])), []
+
+    def range_search(self, lower_bound, upper_bound):
+        # Row ids of the points inside the box, with an empty search path like
+        # the other engines; pages whose box lies inside it are taken whole
+        if not isinstance(lower_bound, np.ndarray):
+            lower_bound = np.array(lower_bound)
+        if not isinstance(upper_bound, np.ndarray):
+            upper_bound = np.array(upper_bound)
+        if not np.all(lower_bound <= upper_bound):
+            raise ValueError("Invalid range: lower_bound must be less than or equal to upper_bound in all dimensions")
+        if self.root == -1:
+            return np.empty(0, dtype=np.int64), []
+
+        parts = []
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            lo, hi = self.node_mins[node], self.node_maxes[node]
+            if np.any(hi < lower_bound) or np.any(lo > upper_bound):
+                continue
+            if self.left[node] != -1:
+                stack.append(self.right[node])
+                stack.append(self.left[node])
+                continue
+            ids, coords = self._page(self.pages[node])
+            if np.all((lower_bound <= lo) & (hi <= upper_bound)):
+                parts.append(ids)
+            else:
+                parts.append(ids[np.all((lower_bound <= coords) & (coords <= upper_bound), axis=1)])
+        return (np.concatenate(parts) if parts else np.empty(0, dtype=np.int64)), []
@@ -0,0 +1,286 @@
+import numpy as np
+import heapq
+from kdTree import KDTree
+from queryCache import QueryCache, copy_result
+
+def _key_array(values):
+    # Cache key part for a query array; coordinates are float64 like the
+    # stored points, so equal queries given as ints or floats share a key
+    values = np.asarray(values, dtype=np.float64)
+    return values.shape, values.tobytes()
+
+class DynamicKDTree:
+
+    # Logarithmic method over static KDTrees: inserts land in a small buffer
+    # that is scanned by brute force, and a full buffer is merged with the
+    # occupied low levels into the first free level, so level i holds about
+    # buffer_size * 2**i points.  Every point keeps the id it was given on
+    # insertion.  Deletes are tombstones: the point's row in its level's
+    # private copy is moved to infinity, which no distance test can match,
+    # and a level is rebuilt once too many of its rows are dead.  Subtrees
+    # taken whole by range and ball queries still hold tombstoned rows, so
+    # those results are filtered by liveness.  The optional result cache is
+    # cleared by every insert and delete.
+
+    def __init__(self, points=None, leaf_size=16, buffer_size=256, rebuild_ratio=0.25, cache_size=0,
+                 cache_bytes=None):
+        self.leaf_size = leaf_size
+        self.buffer_size = buffer_size  # inserts kept out of the trees
+        self.rebuild_ratio = rebuild_ratio  # dead fraction that triggers a level rebuild
+        # Optional LRU cache of single-point query results (0 = off)
+        self.result_cache = QueryCache(cache_size, cache_bytes) if cache_size else None
+
+        self.k = None
+        self.points = None      # coordinates by id (grown by doubling)
+        self.alive = None       # False once an id is deleted
+        self.level_of = None    # level holding each id (-1 = buffer)
+        self.row_of = None      # row of each id inside its level's tree
+        self.n = 0              # ids handed out so far
+        self.n_alive = 0
+
+        self.buffer = []        # ids not yet in a tree
+        self.levels = []        # per level: None or (KDTree, ids of its rows)
+        self.dead = []          # tombstones per level
+
+        if points is not None and len(points):
+            if not isinstance(points, np.ndarray):
+                points = np.array(points)
+            self._reserve(points.shape[1], len(points))
+            self.points[:len(points)] = points
+            self.alive[:len(points)] = True
+            self.n = self.n_alive = len(points)
+            self._place(np.arange(len(points), dtype=np.intp))
+
+    def __len__(self):
+        return self.n_alive
+
+    def invalidate_cache(self):
+        if self.result_cache is not None:
+            self.result_cache.clear()
+    
+    def cache_info(self):
+        # Hit/miss statistics of the result cache (None without one)
+        return None if self.result_cache is None else self.result_cache.info()
+    
+    def _cached(self, key, compute):
+        # Result of compute(), served from the result cache when possible
+        if self.result_cache is None:
+            return compute()
+        hit, result = self.result_cache.get(key)
+        if not hit:
+            result = compute()
+            self.result_cache.put(key, copy_result(result))
+        return copy_result(result)
+    
+    def _reserve(self, k, size):
+        # Grow the per-id arrays to hold at least size ids
+        if self.points is None:
+            self.k = k
+            capacity = max(size, self.buffer_size)
+            self.points = np.zeros((capacity, k))
+            self.alive = np.zeros(capacity, dtype=bool)
+            self.level_of = np.full(capacity, -1, dtype=np.intp)
+            self.row_of = np.zeros(capacity, dtype=np.intp)
+            return
+        if size <= len(self.points):
+            return
+        capacity = max(size, 2 * len(self.points))
+        for name in ('points', 'alive', 'level_of', 'row_of'):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def _build_level(self, level, ids):
+        # Put a static tree over ids at the given level
+        while len(self.levels) <= level:
+            self.levels.append(None)
+            self.dead.append(0)
+        if len(ids) == 0:
+            self.levels[level] = None
+        else:
+            self.levels[level] = (KDTree(self.points[ids], leaf_size=self.leaf_size), ids)
+            self.level_of[ids] = level
+            self.row_of[ids] = np.arange(len(ids))
+        self.dead[level] = 0
+
+    def _place(self, ids):
+        # Merge ids with every occupied level below the first one big enough
+        # to take them all, like carrying in a binary counter
+        level = 0
+        while True:
+            if level >= len(self.levels) or self.levels[level] is None:
+                if len(ids) <= self.buffer_size << level:
+                    self._build_level(level, ids)
+                    return
+            else:
+                tree, level_ids = self.levels[level]
+                ids = np.concatenate((ids, level_ids[self.alive[level_ids]]))
+                self.levels[level] = None
+                self.dead[level] = 0
+            level += 1
+
+    def insert(self, point):
+        if not isinstance(point, np.ndarray):
+            point = np.array(point)
+        self._reserve(len(point), self.n + 1)
+
+        point_id = self.n
+        self.points[point_id] = point
+        self.alive[point_id] = True
+        self.level_of[point_id] = -1
+        self.n += 1
+        self.n_alive += 1
+
+        self.invalidate_cache()
+        self.buffer.append(point_id)
+        if len(self.buffer) >= self.buffer_size:
+            ids = np.array(self.buffer, dtype=np.intp)
+            self.buffer = []
+            self._place(ids)
+        return point_id
+
+    def _find(self, point):
+        # Id of a live point with exactly these coordinates
+        for point_id in self.buffer:
+            if np.array_equal(self.points[point_id], point):
+                return point_id
+        for level in self.levels:
+            if level is None:
+                continue
+            tree, ids = level
+            rows, _ = tree.query_radius(point, 0.0)
+            # Subtrees whole inside the ball are taken without a distance
+            # check, which lets tombstones through
+            rows = rows[self.alive[ids[rows]]]
+            if len(rows):
+                return ids[rows[0]]
+        raise ValueError(f"Point {point} is not in the tree")
+
+    def delete(self, point_or_id):
+        if np.ndim(point_or_id) == 0:
+            point_id = int(point_or_id)
+            if not 0 <= point_id < self.n or not self.alive[point_id]:
+                raise ValueError(f"Id {point_id} is not in the tree")
+        else:
+            point_id = self._find(np.asarray(point_or_id))
+
+        self.alive[point_id] = False
+        self.n_alive -= 1
+        self.invalidate_cache()
+
+        level = self.level_of[point_id]
+        if level == -1:
+            self.buffer.remove(point_id)
+            return
+
+        tree, ids = self.levels[level]
+        tree.all_points[self.row_of[point_id]] = np.inf
+        tree.invalidate_cache()
+        self.dead[level] += 1
+        if self.dead[level] > self.rebuild_ratio * len(ids):
+            self._build_level(level, ids[self.alive[ids]])
+
+    def query(self, X, k=1):
+        # (m, k) squared distances and ids, padded with inf / -1
+        if not isinstance(X, np.ndarray):
+            X = np.array(X)
+        single = X.ndim == 1
+        X = np.atleast_2d(X)
+
+        parts_d = [np.full((len(X), k), np.inf)]
+        parts_i = [np.full((len(X), k), -1, dtype=np.intp)]
+        for level in self.levels:
+            if level is None:
+                continue
+            tree, ids = level
+            distances, rows = tree.query(X, k)
+            found = np.isfinite(distances)
+            parts_d.append(distances)
+            parts_i.append(np.where(found, ids[rows], -1))
+        if self.buffer:
+            ids = np.array(self.buffer, dtype=np.intp)
+            parts_d.append(np.sum((X[:, None, :] - self.points[ids][None, :, :]) ** 2, axis=2))
+            parts_i.append(np.broadcast_to(ids, (len(X), len(ids))))
+
+        distances = np.concatenate(parts_d, axis=1)
+        point_ids = np.concatenate(parts_i, axis=1)
+        order = np.argsort(distances, axis=1, kind='stable')[:, :k]
+        distances = np.take_along_axis(distances, order, axis=1)
+        point_ids = np.take_along_axis(point_ids, order, axis=1)
+        if single:
+            return distances[0], point_ids[0]
+        return distances, point_ids
+
+    def _nearest(self, point, k):
+        # (squared distance, id) pairs of the k nearest live points of one
+        # query, nearest first.  Each level runs its single-point search,
+        # which for one point is far cheaper than a batched query;
+        # tombstones can only come back at infinity.
+        if not isinstance(point, np.ndarray):
+            point = np.array(point)
+        candidates = []
+        for level in self.levels:
+            if level is None:
+                continue
+            tree, ids = level
+            nearest, _ = tree.k_nearest_neighbors(point, k)
+            candidates.extend((dist, ids[row]) for row, dist in nearest if dist < np.inf)
+        if self.buffer:
+            ids = np.array(self.buffer, dtype=np.intp)
+            candidates.extend(zip(np.sum((self.points[ids] - point) ** 2, axis=1), ids))
+        # Stable like query(): ties keep level order, then buffer order
+        return heapq.nsmallest(k, candidates, key=lambda candidate: candidate[0])
+
+    def query_range(self, lower_bound, upper_bound):
+        # Ids of the live points inside the box
+        if not isinstance(lower_bound, np.ndarray):
+            lower_bound = np.array(lower_bound)
+        if not isinstance(upper_bound, np.ndarray):
+            upper_bound = np.array(upper_bound)
+        if not np.all(lower_bound <= upper_bound):
+            raise ValueError("Invalid range: lower_bound must be less than or equal to upper_bound in all dimensions")
+
+        parts = [np.empty(0, dtype=np.intp)]
+        for level in self.levels:
+            if level is None:
+                continue
+            tree, ids = level
+            parts.append(ids[tree.query_range(lower_bound, upper_bound)])
+        if self.buffer:
+            ids = np.array(self.buffer, dtype=np.intp)
+            points = self.points[ids]
+            parts.append(ids[np.all((lower_bound <= points) & (points <= upper_bound), axis=1)])
+        ids = np.concatenate(parts)
+        # Tombstones escape the trees in subtrees taken whole
+        return ids[self.alive[ids]]
+
+    def nearest_neighbor(self, query_point, return_points=False):
+        def _compute():
+            nearest = self._nearest(query_point, 1)
+            if not nearest:
+                return (None, float('inf'))
+            distance, point_id = nearest[0]
+            if return_points:
+                return (self.points[point_id], distance)
+            return (point_id, distance)
+        key = ('nearest_neighbor', _key_array(query_point), return_points)
+        return self._cached(key, _compute), []
+
+    def k_nearest_neighbors(self, query_point, k=1, return_points=False):
+        def _compute():
+            nearest = self._nearest(query_point, k)
+            if return_points:
+                return [(tuple(self.points[i]), d) for d, i in nearest]
+            return [(i, d) for d, i in nearest]
+        key = ('k_nearest_neighbors', _key_array(query_point), k, return_points)
+        return self._cached(key, _compute), []
+
+    def range_search(self, lower_bound, upper_bound, return_points=False):
+        def _compute():
+            point_ids = self.query_range(lower_bound, upper_bound)
+            if return_points:
+                return list(self.points[point_ids])
+            return point_ids
+        key = ('range_search', _key_array(lower_bound), _key_array(upper_bound), return_points)
+        return self._cached(key, _compute), []
@@ -2,31 +2,159 @@ import numpy as np
 import heapq
 import matplotlib.pyplot as plt
 from matplotlib.patches import Rectangle
-from myTime import time_decorator
-import time
+from myTime import time_decorator, count
+from metrics import Cosine, get_metric
+from queryCache import QueryCache, copy_result
+import os
+import json
+import struct
+import multiprocessing
+import threading
+import weakref
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# On-disk layout: magic, format version and header length, a JSON header
+# describing the tree and its arrays, then the raw arrays, each starting
+# on a 64-byte boundary so they can be memory-mapped in place
+FILE_MAGIC = b'KDTREE\x00\x00'
+FILE_VERSION = 1
+FILE_ALIGN = 64
+
+def _aligned(offset):
+    return -(-offset // FILE_ALIGN) * FILE_ALIGN
+
+# Tree of the pool this worker process belongs to, set by _init_worker.
+# Pools are forked, so the tree reaches the workers through copy-on-write
+# memory and only the task arguments and results are pickled.  The pool
+# gets a weak reference so that a tree keeping its pool can still be freed.
+_worker_tree = None
+_pools_lock = threading.Lock()
+
+def _init_worker(tree_ref):
+    global _worker_tree
+    _worker_tree = tree_ref()
+
+def _resolve_workers(workers):
+    if workers is None or workers < 0:
+        return os.cpu_count() or 1
+    return workers
+
+def _can_fork():
+    return 'fork' in multiprocessing.get_all_start_methods()
+
+def _run_chunk(task):
+    method, arrays, args = task
+    return getattr(_worker_tree, method)(*arrays, *args)
+
+@lru_cache(maxsize=None)
+def _subtree_node_count(size, leaf_size):
+    # Splits always happen at the middle position, so the shape of a subtree
+    # depends only on how many points it holds
+    if size <= leaf_size:
+        return 1
+    half = size // 2
+    return 1 + _subtree_node_count(half, leaf_size) + _subtree_node_count(size - half, leaf_size)
+
+def _build_chunk(task):
+    # Build one delegated subtree in a forked worker under its reserved ids
+    start, end, depth, node = task
+    tree = _worker_tree
+    tree.n_nodes = node
+    tree.build_tree(start, end, depth)
+    arrays = [getattr(tree, name)[node:tree.n_nodes] for name in KDTree.NODE_ARRAYS]
+    return start, end, node, tree.indices[start:end], arrays
+
 class KDTree:
     
-    class Node:
-        def __init__(self, point, left=None, right=None, axis=None):
-            self.point = point  # k-dimensional point
-            self.left = left    # left child
-            self.right = right  # right child
-            self.axis = axis    # split axis
+    # The tree is stored as flat arrays indexed by node id instead of one
+    # Python object per point.  Every subtree covers a contiguous slice
+    # indices[node_start:node_end] of the permutation into all_points; points
+    # live only in leaf buckets of at most leaf_size points, and internal
+    # nodes hold the split axis/value and child ids (-1 = leaf).
+    NODE_ARRAYS = ('split_dims', 'split_values', 'left', 'right', 'node_start', 'node_end')
+    # Batched kNN queries of at most this many points run the single-point
+    # search for each of them instead
+    SINGLE_QUERY_GROUP = 8
+    # Most (query, node) pairs the batched walks test per step
+    FRONTIER_PAIRS = 1 << 15
+    # Query leaves of the radius joins wider than the radius along more
+    # axes than this are walked point by point
+    DUAL_WIDE_AXES = 5
     
-    def __init__(self, points):
+    @time_decorator
+    def __init__(self, points, leaf_size=16, presort=False, variance_sample=1000,
+                 build_workers=1, parallel_threshold=None, ids=None, metric=None, cache_size=0, cache_bytes=None):
         if not isinstance(points, np.ndarray):
             points = np.array(points)
         
+        # Optional LRU cache of single-point query results (0 = off)
+        self.result_cache = QueryCache(cache_size, cache_bytes) if cache_size else None
+        
+        # Default distance of the searches; queries can pick another one,
+        # except that cosine needs the points normalized at build time
+        self.metric = get_metric(metric)
+        points = self.metric.prepare(points)
+        
+        # Optional payload id per input row, reported by queries instead of
+        # the row index
+        if ids is not None:
+            ids = np.asarray(ids)
+            if len(ids) != len(points):
+                raise ValueError("ids must have one entry per point")
+        self.ids = ids
+        
         if len(points) == 0:
-            self.root = None
+            self.root = -1
             return
+        if leaf_size < 1:
+            raise ValueError("leaf_size must be at least 1")
             
         self.k = points.shape[1]  # number of dimensions
         self.all_points = points  # store all points for visualization
-        startTime = time.time()
-        self.root = self.build_tree(points, 0)
-        endTime = time.time()
-        print(f"function build_tree took {(endTime - startTime):4f} seconds")
+        self.leaf_size = leaf_size  # max points held by a leaf bucket
+        self.presort = presort  # keep one sorted permutation per axis instead of selecting medians
+        self.variance_sample = variance_sample  # max points used to estimate split variance (None = all)
+        build_workers = _resolve_workers(build_workers)
+        if parallel_threshold is None:
+            parallel_threshold = max(len(points) // (4 * build_workers), leaf_size + 1)
+        
+        # Every split leaves at least ceil(leaf_size / 2) points on each side,
+        # which bounds the number of leaves and therefore of nodes
+        n = len(points)
+        max_nodes = 2 * (n // ((leaf_size + 1) // 2)) + 1
+        self.indices = np.arange(n, dtype=np.intp)               # permuted index into all_points
+        self.split_dims = np.zeros(max_nodes, dtype=np.intp)     # split axis of each node
+        self.split_values = np.zeros(max_nodes, dtype=np.float64)  # split coordinate of each node
+        self.left = np.full(max_nodes, -1, dtype=np.intp)        # left child node id (-1 = leaf)
+        self.right = np.full(max_nodes, -1, dtype=np.intp)       # right child node id (-1 = leaf)
+        self.node_start = np.zeros(max_nodes, dtype=np.intp)     # subtree covers indices[start:end]
+        self.node_end = np.zeros(max_nodes, dtype=np.intp)
+        self.n_nodes = 0
+        
+        if presort:
+            # One permutation per axis, each sorted along its own axis; every
+            # split keeps all of them partitioned into the same segments
+            self._order = np.argsort(points, axis=0, kind='stable').T.copy()
+            self._in_left = np.zeros(n, dtype=bool)
+        
+        # Subtrees smaller than parallel_threshold are handed to worker
+        # processes once the levels above them are split
+        self._tasks = [] if build_workers > 1 and _can_fork() else None
+        self._parallel_threshold = parallel_threshold
+        self.root = self.build_tree(0, n, 0)
+        if self._tasks:
+            self._build_delegated(build_workers)
+        self._tasks = None
+        
+        if presort:
+            del self._order, self._in_left
+        
+        # Drop the unused tail of the node arrays
+        for name in self.NODE_ARRAYS:
+            setattr(self, name, getattr(self, name)[:self.n_nodes].copy())
+        self._compute_boxes()
+        self._refresh_caches()
     
     def find_highest_variance_axis(self, points):
         # Calculate variance along each dimension
@@ -35,158 +163,1451 @@ class KDTree:
         # Return the index of the dimension with highest variance
         return np.argmax(variances)
     
-    def build_tree(self, points, depth):
-        if len(points) == 0:
-            return None
+    def _split_axis(self, idx):
+        # Estimate the variance on an evenly strided sample of the segment so
+        # that large nodes do not gather all of their rows
+        if self.variance_sample and len(idx) > self.variance_sample:
+            idx = idx[::len(idx) // self.variance_sample]
+        return self.find_highest_variance_axis(points=self.all_points[idx])
+    
+    def build_tree(self, start, end, depth):
+        # Build the subtree over indices[start:end] and return its node id
+        node = self.n_nodes
+        if self._tasks is not None and self.leaf_size < end - start <= self._parallel_threshold:
+            # Reserve the ids the serial build would give this subtree and
+            # leave the subtree itself to a worker
+            self.n_nodes += _subtree_node_count(end - start, self.leaf_size)
+            self._tasks.append((start, end, depth, node))
+            return node
+        self.n_nodes += 1
+        self.node_start[node] = start
+        self.node_end[node] = end
+        
+        if end - start <= self.leaf_size:
+            return node
             
-        # Select axis based on depth so that axis cycles through all dimensions
-        axis = self.find_highest_variance_axis(points=points)
-        # axis = depth % self.k
+        # Points before mid go left, the rest go right
+        mid = start + (end - start) // 2
         
-        # Sort points along the selected axis
-        points = points[points[:, axis].argsort()]
+        if self.presort:
+            axis = self._split_axis(self._order[0, start:end])
+            self._partition_presorted(start, end, mid, axis)
+        else:
+            idx = self.indices[start:end]  # view, partitioned in place
+            
+            # Select axis based on depth so that axis cycles through all dimensions
+            axis = self._split_axis(idx)
+            # axis = depth % self.k
+            
+            # Move the median to mid with smaller values before it
+            idx[:] = idx[np.argpartition(self.all_points[idx, axis], mid - start)]
         
-        # Get the median point
-        median_idx = len(points) // 2
+        self.split_dims[node] = axis
+        self.split_values[node] = self.all_points[self.indices[mid], axis]
         
-        # Create node and recursively construct subtrees
-        node = self.Node(
-            point=points[median_idx],
-            axis=axis,
-            left=self.build_tree(points[:median_idx], depth + 1),
-            right=self.build_tree(points[median_idx+1:], depth + 1)
-        )
+        # Recursively construct subtrees
+        self.left[node] = self.build_tree(start, mid, depth + 1)
+        self.right[node] = self.build_tree(mid, end, depth + 1)
         
         return node
     
+    def _build_delegated(self, workers):
+        # Every delegated segment is final in the parent by now, so the
+        # workers can be forked and fill in their reserved id ranges
+        tasks, self._tasks = self._tasks, None
+        with self._process_pool(workers) as pool:
+            for start, end, node, indices, arrays in pool.map(_build_chunk, tasks):
+                self.indices[start:end] = indices
+                for name, values in zip(self.NODE_ARRAYS, arrays):
+                    getattr(self, name)[node:node + len(values)] = values
+    
+    def _process_pool(self, workers):
+        # Forked pool whose workers all hold this tree, passed through the
+        # initializer so concurrent pools of other trees cannot mix them up
+        return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork'),
+                                   initializer=_init_worker, initargs=(weakref.ref(self),))
+    
+    def _partition_presorted(self, start, end, mid, axis):
+        # The median along axis is read straight from that axis' sorted
+        # permutation; the other permutations are split with a stable
+        # partition so each of them stays sorted inside both halves
+        order = self._order
+        left_set = order[axis, start:mid]
+        self._in_left[left_set] = True
+        for dim in range(self.k):
+            if dim == axis:
+                continue
+            seg = order[dim, start:end]
+            mask = self._in_left[seg]
+            order[dim, start:end] = np.concatenate((seg[mask], seg[~mask]))
+        self._in_left[left_set] = False
+        self.indices[start:end] = order[axis, start:end]
+    
+    def _compute_boxes(self):
+        # Tight bounding box of every node's points.  Leaves are the
+        # consecutive slices of indices in preorder, so one reduceat covers
+        # them all; internal nodes then merge their children level by level
+        # from the bottom up.
+        n_nodes = len(self.left)
+        points = self.all_points[self.indices]
+        leaves = np.flatnonzero(self.left == -1)
+        self.node_mins = np.empty((n_nodes, self.k), dtype=points.dtype)
+        self.node_maxes = np.empty((n_nodes, self.k), dtype=points.dtype)
+        self.node_mins[leaves] = np.minimum.reduceat(points, self.node_start[leaves])
+        self.node_maxes[leaves] = np.maximum.reduceat(points, self.node_start[leaves])
+        
+        levels = []
+        frontier = np.array([self.root], dtype=np.intp)
+        while len(frontier):
+            frontier = frontier[self.left[frontier] != -1]
+            levels.append(frontier)
+            frontier = np.concatenate((self.left[frontier], self.right[frontier]))
+        for nodes in reversed(levels):
+            left, right = self.left[nodes], self.right[nodes]
+            self.node_mins[nodes] = np.minimum(self.node_mins[left], self.node_mins[right])
+            self.node_maxes[nodes] = np.maximum(self.node_maxes[left], self.node_maxes[right])
+    
+    def _box_gaps(self, node, query_point):
+        # Per-axis distance from a query point to the nearest and the
+        # farthest side of a node's box
+        lo, hi = self.node_mins[node], self.node_maxes[node]
+        near = np.maximum(np.maximum(lo - query_point, query_point - hi), 0.0)
+        far = np.maximum(query_point - lo, hi - query_point)
+        return near, far
+    
+    def _box_distance(self, node, query_point, metric):
+        # Reduced distance from a query point to a node's box, a lower bound
+        # for every point below the node
+        lo, hi = self.node_mins[node], self.node_maxes[node]
+        return float(metric.reduced(np.maximum(np.maximum(lo - query_point, query_point - hi), 0.0)))
+    
+    def is_leaf(self, node):
+        return self.left[node] == -1
+    
+    def node_points(self, node):
+        # Coordinates of every point in the subtree of a node
+        return self.all_points[self.indices[self.node_start[node]:self.node_end[node]]]
+    
+    def node_size(self, node):
+        # Number of points in the subtree of a node
+        return self.node_end[node] - self.node_start[node]
+    
+    def _label(self, index):
+        # Map row indices into all_points to what queries report: the row
+        # index itself, or the caller's id for that row (-1 stays -1)
+        if self.ids is None:
+            return index
+        if np.ndim(index) == 0:
+            return -1 if index == -1 else self.ids[index]
+        labels = self.ids[np.maximum(index, 0)]
+        missing = index == -1
+        if missing.any():
+            # Signed and float ids take the -1 padding in their own dtype;
+            # any other kind of id needs an object array to hold it
+            if labels.dtype.kind in 'if':
+                labels[missing] = -1
+            else:
+                labels = labels.astype(object)
+                labels[missing] = -1
+        return labels
+    
+    def _metric(self, metric):
+        # Metric of one query: the tree's own unless another one is given
+        if metric is None:
+            return self.metric
+        metric = get_metric(metric)
+        if isinstance(metric, Cosine) != isinstance(self.metric, Cosine):
+            raise ValueError("The cosine metric must be chosen when the tree is built")
+        return metric
+    
+    def _cache_key(self, operation, metric, arrays, *args):
+        # Result cache key: the query arrays' bytes, the metric unless it is
+        # the tree's own, and every other argument that changes the answer
+        metric_key = None if metric is self.metric else json.dumps(metric.spec())
+        return (operation, metric_key) + tuple((a.dtype.str, a.shape, a.tobytes()) for a in arrays) + args
+    
+    def invalidate_cache(self):
+        # Forget cached results and the workers' copies of the tree; needed
+        # whenever the points are modified
+        if self.result_cache is not None:
+            self.result_cache.clear()
+        self.shutdown_pools()
+    
+    def cache_info(self):
+        # Hit/miss statistics of the result cache (None without one)
+        return None if self.result_cache is None else self.result_cache.info()
+    
+    def _refresh_caches(self, lists=True):
+        # Python-list copies of the node arrays for the single-query loops:
+        # indexing a list yields plain ints/floats, whereas indexing an
+        # ndarray allocates a NumPy scalar for every visited node.  Without
+        # lists the loops index the node arrays themselves.
+        convert = (lambda array: array.tolist()) if lists else (lambda array: array)
+        self._left_list = convert(self.left)
+        self._right_list = convert(self.right)
+        self._dims_list = convert(self.split_dims)
+        self._splits_list = convert(self.split_values)
+        self._start_list = convert(self.node_start)
+        self._end_list = convert(self.node_end)
+        # Extent of each node's box along its own split axis
+        nodes = np.arange(len(self.left))
+        self._box_lo_list = convert(self.node_mins[nodes, self.split_dims])
+        self._box_hi_list = convert(self.node_maxes[nodes, self.split_dims])
+    
     @time_decorator
-    def nearest_neighbor(self, query_point):
-        if self.root is None:
+    def nearest_neighbor(self, query_point, trace=False, return_points=False, metric=None):
+        if self.root == -1:
             return None, float('inf')
+        if self._left_list is None:
+            self._refresh_caches()
             
         if not isinstance(query_point, np.ndarray):
             query_point = np.array(query_point)
-            
-        best = [None, float('inf')]  # [nearest_point, nearest_distance]
-        search_path = []  # Store nodes visited for visualization
+        metric = self._metric(metric)
+        euclidean = metric.is_euclidean
+        query_point = metric.prepare_queries(query_point)
+        key = None
+        if self.result_cache is not None and not trace:
+            key = self._cache_key('nearest_neighbor', metric, (query_point,), return_points)
+            hit, result = self.result_cache.get(key)
+            if hit:
+                count('KDTree.nearest_neighbor', cache_hits=1)
+                return copy_result(result), []
+        q = query_point.tolist()
         
-        def _search(node):
-            if node is None:
-                return
+        lefts, rights = self._left_list, self._right_list
+        dims, splits = self._dims_list, self._splits_list
+        starts, ends = self._start_list, self._end_list
+        
+        best_index, best_distance = -1, float('inf')
+        search_path = []  # Store nodes visited for visualization (trace only)
+        visited = evaluated = pruned = 0  # work counters for the stats
+        
+        # Each entry is a node, a lower bound on its (reduced) distance and
+        # whether that bound may be raised to the distance to the node's box
+        stack = [(self.root, 0.0, False)]
+        while stack:
+            node, bound, far = stack.pop()
+            # If the distance to the splitting plane is not below the current
+            # best distance, the subtree cannot hold a closer point
+            if bound >= best_distance:
+                pruned += 1
+                continue
+            left = lefts[node]
+            # Far subtrees that survive the plane test get the tighter test
+            # against their box
+            if far and left != -1 and self._box_distance(node, query_point, metric) >= best_distance:
+                pruned += 1
+                continue
+            visited += 1
+            if trace:
+                search_path.append(node)
                 
-            search_path.append(node)
-            
-            # Compute current distance
-            current_distance = np.sum((query_point - node.point) ** 2)
-            
-            # Update best if current point is closer
-            if current_distance < best[1]:
-                best[0] = node.point
-                best[1] = current_distance
-            
-            # Decide which subtree to search first based on query point position
-            if query_point[node.axis] < node.point[node.axis]:
-                first, second = node.left, node.right
-            else:
-                first, second = node.right, node.left
+            if left == -1:
+                # Scan the whole bucket at once
+                ids = self.indices[starts[node]:ends[node]]
+                evaluated += len(ids)
+                distances = metric.reduced(self.all_points[ids] - query_point)
+                i = distances.argmin()
+                if distances[i] < best_distance:
+                    best_index, best_distance = ids[i], distances[i]
+                continue
                 
-            # Search the most promising subtree first
-            _search(first)
-            
-            # Check if we need to search the other subtree
-            # If the distance to the splitting plane is greater than the current best distance,
-            # we don't need to search the other subtree
-            if (query_point[node.axis] - node.point[node.axis])**2 < best[1]:
-                _search(second)
+            axis = dims[node]
+            diff = q[axis] - splits[node]
+            # The gap along a single axis bounds the distance for every metric
+            plane = diff * diff if euclidean else metric.axis_term(diff, axis)
+            near, far = (left, rights[node]) if diff < 0 else (rights[node], left)
+            # The most promising subtree goes on top of the stack
+            stack.append((far, plane if plane > bound else bound, True))
+            stack.append((near, bound, False))
         
-        _search(self.root)
-        return tuple(best), search_path
+        count('KDTree.nearest_neighbor', nodes_visited=visited, distance_evaluations=evaluated,
+              pruned_subtrees=pruned, results=1)
+        if return_points:
+            result = (self.all_points[best_index], best_distance)
+        else:
+            result = (self._label(best_index), best_distance)
+        if key is not None:
+            self.result_cache.put(key, result)
+        return result, search_path
+    
+    def _push_leaf(self, nearest, k, node, query_point, metric):
+        # Scan a whole bucket at once and only push the candidates that beat
+        # the current k-th distance; returns the number of points checked
+        ids = self.indices[self._start_list[node]:self._end_list[node]]
+        distances = metric.reduced(self.all_points[ids] - query_point)
+        if len(nearest) == k:
+            candidates = np.flatnonzero(distances < -nearest[0][0])
+        else:
+            candidates = range(len(ids))
+        for i in candidates:
+            if len(nearest) < k:
+                heapq.heappush(nearest, (-distances[i], ids[i]))
+            elif -nearest[0][0] > distances[i]:
+                heapq.heappushpop(nearest, (-distances[i], ids[i]))
+        return len(ids)
     
     @time_decorator
-    def k_nearest_neighbors(self, query_point, k=1):
-        if self.root is None:
+    def k_nearest_neighbors(self, query_point, k=1, trace=False, eps=0.0, max_checks=None, return_points=False,
+                            metric=None):
+        # eps > 0 or max_checks switches to approximate best-bin-first search:
+        # every returned distance is within (1 + eps) of the true k-th
+        # neighbour's, and the search stops after max_checks scanned points
+        if self.root == -1:
             return []
+        if self._left_list is None:
+            self._refresh_caches()
             
         if not isinstance(query_point, np.ndarray):
             query_point = np.array(query_point)
-            
+        metric = self._metric(metric)
+        query_point = metric.prepare_queries(query_point)
+        key = None
+        if self.result_cache is not None and not trace:
+            key = self._cache_key('k_nearest_neighbors', metric, (query_point,), k, eps, max_checks, return_points)
+            hit, result = self.result_cache.get(key)
+            if hit:
+                count('KDTree.k_nearest_neighbors', cache_hits=1)
+                return copy_result(result), []
+        q = query_point.tolist()
+        
         # Use a max heap to keep track of the k nearest neighbors
-        nearest = []  # (negative distance, point) pairs
-        search_path = []  # Store nodes visited for visualization
+        nearest = []  # (negative distance, point index) pairs
+        search_path = []  # Store nodes visited for visualization (trace only)
         
-        def _search(node):
-            if node is None:
-                return
+        if eps > 0 or max_checks is not None:
+            visited, evaluated, pruned = self._best_bin_first(nearest, k, query_point, q, eps, max_checks,
+                                                              search_path if trace else None, metric)
+        else:
+            visited, evaluated, pruned = self._depth_first(nearest, k, query_point, q, self.root,
+                                                           search_path if trace else None, metric)
+        
+        count('KDTree.k_nearest_neighbors', nodes_visited=visited, distance_evaluations=evaluated,
+              pruned_subtrees=pruned, results=len(nearest))
+        # Convert heap to sorted list of (index, distance) pairs
+        nearest.sort(reverse=True)
+        if return_points:
+            result = [(tuple(self.all_points[i]), -dist) for dist, i in nearest]
+        elif self.ids is None:
+            result = [(i, -dist) for dist, i in nearest]
+        else:
+            result = [(self.ids[i], -dist) for dist, i in nearest]
+        if key is not None:
+            self.result_cache.put(key, copy_result(result))
+        return result, search_path
+    
+    def _depth_first(self, nearest, k, query_point, q, node, search_path, metric):
+        # Exact search of the subtree of node, nearest child first, keeping
+        # the k best points in the max-heap nearest.  Returns the nodes
+        # visited, the points checked and the subtrees pruned.
+        lefts, rights = self._left_list, self._right_list
+        dims, splits = self._dims_list, self._splits_list
+        euclidean = metric.is_euclidean
+        visited = evaluated = pruned = 0
+        stack = [(node, 0.0, False)]
+        while stack:
+            node, bound, far = stack.pop()
+            # Once the heap is full, skip subtrees beyond the furthest point in it
+            full = len(nearest) == k
+            if full and bound >= -nearest[0][0]:
+                pruned += 1
+                continue
+            left = lefts[node]
+            if far and full and left != -1 and self._box_distance(node, query_point, metric) >= -nearest[0][0]:
+                pruned += 1
+                continue
+            visited += 1
+            if search_path is not None:
+                search_path.append(node)
                 
-            search_path.append(node)
-            
-            # Compute current distance
-            current_distance = np.sum((query_point - node.point) ** 2)
-            
-            # If we have less than k points or current point is closer than the furthest point in our heap
-            if len(nearest) < k or -nearest[0][0] > current_distance:
-                # Add current point to heap
-                if len(nearest) == k:
-                    heapq.heappushpop(nearest, (-current_distance, tuple(node.point)))
-                else:
-                    heapq.heappush(nearest, (-current_distance, tuple(node.point)))
-            
-            # Decide which subtree to search first based on query point position
-            if query_point[node.axis] < node.point[node.axis]:
-                first, second = node.left, node.right
-            else:
-                first, second = node.right, node.left
+            if left == -1:
+                evaluated += self._push_leaf(nearest, k, node, query_point, metric)
+                continue
                 
-            # Search the most promising subtree first
-            _search(first)
-            
-            # Check if we need to search the other subtree
-            # If the distance to the splitting plane is greater than the furthest point in our heap,
-            # we don't need to search the other subtree
-            if len(nearest) < k or abs(query_point[node.axis] - node.point[node.axis]) ** 2 < -nearest[0][0]:
-                _search(second)
-        
-        _search(self.root)
+            axis = dims[node]
+            diff = q[axis] - splits[node]
+            plane = diff * diff if euclidean else metric.axis_term(diff, axis)
+            near, far = (left, rights[node]) if diff < 0 else (rights[node], left)
+            # The most promising subtree goes on top of the stack
+            stack.append((far, plane if plane > bound else bound, True))
+            stack.append((near, bound, False))
+        return visited, evaluated, pruned
+    
+    def _best_bin_first(self, nearest, k, query_point, q, eps, max_checks, search_path, metric):
+        # Visit leaves in order of their distance bound, kept in a min-heap,
+        # instead of in depth-first order.  Returns the nodes visited, the
+        # points checked and the bins left unexplored.
+        lefts, rights = self._left_list, self._right_list
+        dims, splits = self._dims_list, self._splits_list
+        euclidean = metric.is_euclidean
+        scale = metric.from_distance(1.0 + eps) / metric.from_distance(1.0)  # (1 + eps) in reduced form
+        checks = visited = 0
         
-        # Convert heap to sorted list of (point, distance) pairs
-        result = [(point, -dist) for dist, point in sorted(nearest, reverse=True)]
-        return result, search_path
+        bins = [(0.0, self.root)]
+        while bins:
+            bound, node = heapq.heappop(bins)
+            # Every remaining bin is at least this far away
+            if len(nearest) == k and bound * scale >= -nearest[0][0]:
+                break
+                
+            # Descend to the leaf holding the closest part of this bin and
+            # queue the far side of every split on the way
+            while lefts[node] != -1:
+                visited += 1
+                if search_path is not None:
+                    search_path.append(node)
+                axis = dims[node]
+                diff = q[axis] - splits[node]
+                plane = diff * diff if euclidean else metric.axis_term(diff, axis)
+                if diff < 0:
+                    near, far = lefts[node], rights[node]
+                else:
+                    near, far = rights[node], lefts[node]
+                far_bound = plane if plane > bound else bound
+                if len(nearest) < k or far_bound * scale < -nearest[0][0]:
+                    far_bound = self._box_distance(far, query_point, metric)
+                heapq.heappush(bins, (far_bound, far))
+                node = near
+                
+            visited += 1
+            if search_path is not None:
+                search_path.append(node)
+            checks += self._push_leaf(nearest, k, node, query_point, metric)
+            if max_checks is not None and checks >= max_checks:
+                break
+        return visited, checks, len(bins)
     
-    @time_decorator
-    def range_search(self, lower_bound, upper_bound):
-        if self.root is None:
-            return []
-            
+    def _check_range(self, lower_bound, upper_bound):
         if not isinstance(lower_bound, np.ndarray):
             lower_bound = np.array(lower_bound)
         if not isinstance(upper_bound, np.ndarray):
             upper_bound = np.array(upper_bound)
         if not np.all(lower_bound <= upper_bound):
             raise ValueError("Invalid range: lower_bound must be less than or equal to upper_bound in all dimensions")
+        return lower_bound, upper_bound
+    
+    def _range_parts(self, lower_bound, upper_bound, search_path, name):
+        # Generate the matches of a range query as index arrays, one per
+        # matching leaf or subtree taken whole, in traversal order.  Work
+        # counters go to the stats under name when the walk ends or is
+        # abandoned.
+        if self._left_list is None:
+            self._refresh_caches()
+        lower, upper = lower_bound.tolist(), upper_bound.tolist()
         
-        result = []
-        search_path = []  # Store nodes visited for visualization
+        lefts, rights = self._left_list, self._right_list
+        dims, splits = self._dims_list, self._splits_list
+        starts, ends = self._start_list, self._end_list
+        box_lo, box_hi = self._box_lo_list, self._box_hi_list
         
-        def _search(node):
-            if node is None:
-                return
+        visited = evaluated = pruned = results = 0
+        stack = [self.root]
+        try:
+            while stack:
+                node = stack.pop()
+                visited += 1
+                if search_path is not None:
+                    search_path.append(node)
+                    
+                left = lefts[node]
+                # A subtree whose box lies inside the range is taken whole; the
+                # split axis alone rules most nodes out before the full test
+                axis = dims[node]
+                if left != -1 and lower[axis] <= box_lo[node] and box_hi[node] <= upper[axis] and \
+                   np.all((lower_bound <= self.node_mins[node]) & (self.node_maxes[node] <= upper_bound)):
+                    results += ends[node] - starts[node]
+                    yield self.indices[starts[node]:ends[node]]
+                    continue
+                if left == -1:
+                    # Check which points of the bucket are within the range
+                    ids = self.indices[starts[node]:ends[node]]
+                    points = self.all_points[ids]
+                    evaluated += len(ids)
+                    inside = np.all((lower_bound <= points) & (points <= upper_bound), axis=1)
+                    if np.any(inside):
+                        results += int(np.count_nonzero(inside))
+                        yield ids[inside]
+                    continue
+                    
+                split = splits[node]
+                
+                # Check if the right subtree needs to be searched
+                if upper[axis] >= split:
+                    stack.append(rights[node])
+                else:
+                    pruned += 1
+                    
+                # Check if the left subtree needs to be searched (popped first)
+                if lower[axis] <= split:
+                    stack.append(left)
+                else:
+                    pruned += 1
+        finally:
+            count(name, nodes_visited=visited, distance_evaluations=evaluated, pruned_subtrees=pruned,
+                  results=results)
+    
+    @time_decorator
+    def range_search(self, lower_bound, upper_bound, trace=False, return_points=False):
+        if self.root == -1:
+            return []
+        lower_bound, upper_bound = self._check_range(lower_bound, upper_bound)
+        key = None
+        if self.result_cache is not None and not trace:
+            key = self._cache_key('range_search', self.metric, (lower_bound, upper_bound), return_points)
+            hit, result = self.result_cache.get(key)
+            if hit:
+                count('KDTree.range_search', cache_hits=1)
+                return copy_result(result), []
+        
+        search_path = []  # Store nodes visited for visualization (trace only)
+        result = list(self._range_parts(lower_bound, upper_bound, search_path if trace else None,
+                                      'KDTree.range_search'))
+        result = np.concatenate(result) if result else np.empty(0, dtype=np.intp)
+        result = list(self.all_points[result]) if return_points else self._label(result)
+        if key is not None:
+            self.result_cache.put(key, copy_result(result))
+        return result, search_path
+    
+    def iter_range_search(self, lower_bound, upper_bound, chunk_size=65536, limit=None, return_points=False):
+        # Matches of range_search as a stream of arrays of chunk_size
+        # entries (the last one shorter), produced while the tree is walked;
+        # at most limit matches are returned.  Memory stays at one chunk
+        # however many points fall in the range.  The arguments are checked
+        # here, on the call, rather than on the first next() of the stream.
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1")
+        if limit is not None and limit < 0:
+            raise ValueError("limit must not be negative")
+        lower_bound, upper_bound = self._check_range(lower_bound, upper_bound)
+        return self._iter_range_search(lower_bound, upper_bound, chunk_size, limit, return_points)
+    
+    def _iter_range_search(self, lower_bound, upper_bound, chunk_size, limit, return_points):
+        if self.root == -1 or limit == 0:
+            return
+            
+        def _emit(parts):
+            chunk = np.concatenate(parts)
+            return self.all_points[chunk] if return_points else self._label(chunk)
+            
+        parts, buffered, remaining = [], 0, limit
+        for ids in self._range_parts(lower_bound, upper_bound, None, 'KDTree.iter_range_search'):
+            if remaining is not None:
+                ids = ids[:remaining]
+                remaining -= len(ids)
+            # Subtrees taken whole can be far bigger than a chunk
+            while len(ids):
+                take = ids[:chunk_size - buffered]
+                parts.append(take)
+                buffered += len(take)
+                ids = ids[len(take):]
+                if buffered == chunk_size:
+                    yield _emit(parts)
+                    parts, buffered = [], 0
+            if remaining == 0:
+                break
+        if buffered:
+            yield _emit(parts)
+    
+    def _radius_search(self, query_point, r, metric, count_only, search_path):
+        # Walk the nodes whose box comes within r of the query point.  A box
+        # whose farthest corner is inside the ball holds nothing but matches,
+        # so its points are taken (or counted from the subtree size) without
+        # any distance.  Returns the count or the index arrays of the result.
+        if not isinstance(query_point, np.ndarray):
+            query_point = np.array(query_point)
+        query_point = metric.prepare_queries(query_point)
+        radius = metric.from_distance(r)
+        
+        lefts, rights = self._left_list, self._right_list
+        starts, ends = self._start_list, self._end_list
+        
+        found = 0
+        parts = []
+        visited = evaluated = pruned = 0  # work counters for the stats
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            near, far = self._box_gaps(node, query_point)
+            if metric.reduced(near) > radius:
+                pruned += 1
+                continue
+            visited += 1
+            if search_path is not None:
+                search_path.append(node)
+                
+            if metric.reduced(far) <= radius:
+                found += ends[node] - starts[node]
+                if not count_only:
+                    parts.append(self.indices[starts[node]:ends[node]])
+                continue
+            left = lefts[node]
+            if left == -1:
+                ids = self.indices[starts[node]:ends[node]]
+                evaluated += len(ids)
+                inside = metric.reduced(self.all_points[ids] - query_point) <= radius
+                found += int(np.count_nonzero(inside))
+                if not count_only:
+                    parts.append(ids[inside])
+                continue
+            stack.append(rights[node])
+            stack.append(left)
+        
+        count('KDTree.count_radius' if count_only else 'KDTree.query_radius', nodes_visited=visited,
+              distance_evaluations=evaluated, pruned_subtrees=pruned, results=found)
+        return found if count_only else parts
+    
+    @time_decorator
+    def query_radius(self, query_point, r, trace=False, return_points=False, metric=None):
+        # Every point within distance r of the query point
+        if self.root == -1:
+            return []
+        if self._left_list is None:
+            self._refresh_caches()
+            
+        search_path = []  # Store nodes visited for visualization (trace only)
+        parts = self._radius_search(query_point, r, self._metric(metric), False, search_path if trace else None)
+        result = np.concatenate(parts) if parts else np.empty(0, dtype=np.intp)
+        if return_points:
+            return list(self.all_points[result]), search_path
+        return self._label(result), search_path
+    
+    @time_decorator
+    def count_radius(self, query_point, r, metric=None):
+        # Number of points within distance r of the query point
+        if self.root == -1:
+            return 0
+        if self._left_list is None:
+            self._refresh_caches()
+        return self._radius_search(query_point, r, self._metric(metric), True, None)
+    
+    # Batched queries: all query points walk the tree together, so every
+    # visited node costs a handful of NumPy calls for the whole batch instead
+    # of a Python call per query.  Results are indices into all_points (or
+    # the caller's ids) and distances are in the metric's reduced form
+    # (squared for Euclidean), like the rest of the class.
+    
+    def _descend(self, X):
+        # Leaf id that each query point falls into
+        nodes = np.full(len(X), self.root, dtype=np.intp)
+        active = np.flatnonzero(self.left[nodes] != -1)
+        while len(active):
+            node = nodes[active]
+            go_left = X[active, self.split_dims[node]] < self.split_values[node]
+            nodes[active] = np.where(go_left, self.left[node], self.right[node])
+            active = active[self.left[nodes[active]] != -1]
+        return nodes
+    
+    def _leaf_ids(self, node):
+        return self.indices[self.node_start[node]:self.node_end[node]]
+    
+    def _group_pairs(self, m, query_parts, id_parts):
+        # Turn (query, point id) pairs into one index array per query
+        if not query_parts:
+            return [np.empty(0, dtype=np.intp) for _ in range(m)]
+        queries = np.concatenate(query_parts)
+        ids = np.concatenate(id_parts)
+        order = np.argsort(queries, kind='stable')
+        splits = np.searchsorted(queries[order], np.arange(1, m))
+        return np.split(ids[order], splits)
+    
+    def _map_chunks(self, method, workers, arrays, args, key):
+        # Run a batched method over slices of its per-query arrays in a pool
+        # and return its result for the whole batch, in input order.  The
+        # queries are sorted by the leaf their key point falls into first,
+        # so each worker gets one spatially compact slice and walks the
+        # upper levels of the tree once instead of once per scattered slice.
+        workers = _resolve_workers(workers)
+        m = len(arrays[0])
+        if workers <= 1 or m < 2 * workers or self.root == -1:
+            return getattr(self, method)(*arrays, *args)
+        
+        order = np.argsort(self._descend(key), kind='stable')
+        tasks = [(method, [a[part] for a in arrays], args) for part in np.array_split(order, workers)]
+        pool = self._pool(workers)
+        if isinstance(pool, ProcessPoolExecutor):
+            chunks = list(pool.map(_run_chunk, tasks))
+        else:
+            chunks = list(pool.map(lambda task: getattr(self, task[0])(*task[1], *task[2]), tasks))
+        
+        inverse = np.empty(m, dtype=np.intp)
+        inverse[order] = np.arange(m)
+        if isinstance(chunks[0], tuple):
+            return tuple(np.concatenate(parts)[inverse] for parts in zip(*chunks))
+        if isinstance(chunks[0], np.ndarray):
+            return np.concatenate(chunks)[inverse]
+        rows = [row for chunk in chunks for row in chunk]
+        return [rows[i] for i in inverse]
+    
+    def _pool(self, workers):
+        # Pool of the batched queries, kept between calls.  Forked workers
+        # hold a copy of the tree as it was when they started, so
+        # invalidate_cache() shuts them down; without fork, threads share
+        # the tree directly.
+        with _pools_lock:
+            pools = self.__dict__.setdefault('_pools', {})
+            pool = pools.get(workers)
+            if pool is None:
+                pool = pools[workers] = self._process_pool(workers) if _can_fork() else ThreadPoolExecutor(workers)
+            return pool
+    
+    def shutdown_pools(self):
+        # Stop the worker pools kept for queries with workers > 1; the next
+        # such query starts a new one
+        with _pools_lock:
+            pools, self._pools = self.__dict__.get('_pools', {}), {}
+        for pool in pools.values():
+            pool.shutdown(wait=False)
+    
+    def __getstate__(self):
+        # Worker pools belong to this process and can't be pickled; the
+        # copy starts its own on its first query with workers > 1
+        state = self.__dict__.copy()
+        state.pop('_pools', None)
+        return state
+    
+    @time_decorator
+    def query(self, X, k=1, workers=1, metric=None):
+        if not isinstance(X, np.ndarray):
+            X = np.array(X)
+        single = X.ndim == 1
+        metric = self._metric(metric)
+        X = metric.prepare_queries(np.atleast_2d(X))
+        
+        best_d, best_i = self._map_chunks('_query', workers, (X,), (k, metric), X)
+        best_i = self._label(best_i)
+        if single:
+            return best_d[0], best_i[0]
+        return best_d, best_i
+    
+    def _query(self, X, k, metric):
+        m = len(X)
+        best_d = np.full((m, k), np.inf, dtype=metric.dtype)
+        best_i = np.full((m, k), -1, dtype=np.intp)
+        if self.root == -1 or not m:
+            return best_d, best_i
+        # Work counters for the stats: (query, node) visits, query-point
+        # distances, and (query, node) pairs dropped
+        work = {'nodes_visited': 0, 'distance_evaluations': 0, 'pruned_subtrees': 0}
+        
+        if m <= self.SINGLE_QUERY_GROUP:
+            # A few queries cost less one at a time than the NumPy calls of
+            # the traversal below
+            if self._left_list is None:
+                self._refresh_caches()
+            for i in range(m):
+                nearest = []
+                visited, evaluated, pruned = self._depth_first(nearest, k, X[i], X[i].tolist(), self.root, None,
+                                                               metric)
+                work['nodes_visited'] += visited
+                work['distance_evaluations'] += evaluated
+                work['pruned_subtrees'] += pruned
+                nearest.sort(reverse=True)
+                best_d[i, :len(nearest)] = [-dist for dist, _ in nearest]
+                best_i[i, :len(nearest)] = [index for _, index in nearest]
+            count('KDTree.query', results=int(np.count_nonzero(best_i != -1)), **work)
+            return best_d, best_i
+        
+        # Every query starts with an upper bound of its k-th distance, then
+        # (query, node) pairs walk down the tree one level per step: the
+        # pairs of a level are tested against the node boxes in one NumPy
+        # call and the pairs reaching a leaf are scanned in stacked blocks,
+        # so the number of NumPy calls depends on the depth of the tree and
+        # not on how the queries are spread over it
+        leaves, padded = self._padded_leaves()
+        kth = self._kth_bounds(X, k, metric)
+        slack = self._bound_slack(metric)
+        slot = np.zeros(len(self.left), dtype=np.intp)
+        slot[leaves] = np.arange(len(leaves))
+        step = max(1, (1 << 20) // padded.shape[1])
+        
+        # The frontier is cut into chunks of at most FRONTIER_PAIRS pairs and
+        # walked depth first, so memory does not grow with the batch.  The
+        # queries go in the order of the leaf they fall into, which keeps
+        # the queries of a chunk close together and their frontier small.
+        chunk = self.FRONTIER_PAIRS
+        order = np.argsort(self._descend(X), kind='stable')
+        frontier = [(order, np.full(m, self.root, dtype=np.intp))]
+        while frontier:
+            pair_q, pair_n = frontier.pop()
+            if len(pair_q) > chunk:
+                frontier.append((pair_q[chunk:], pair_n[chunk:]))
+                pair_q, pair_n = pair_q[:chunk], pair_n[:chunk]
+            Xq = X[pair_q]
+            gap = np.maximum(np.maximum(self.node_mins[pair_n] - Xq, Xq - self.node_maxes[pair_n]), 0.0)
+            keep = metric.reduced(gap) <= kth[pair_q] * slack
+            work['pruned_subtrees'] += len(keep) - int(np.count_nonzero(keep))
+            pair_q, pair_n = pair_q[keep], pair_n[keep]
+            work['nodes_visited'] += len(pair_q)
+            
+            at_leaf = self.left[pair_n] == -1
+            leaf_q, leaf_n = pair_q[at_leaf], pair_n[at_leaf]
+            for lo in range(0, len(leaf_q), step):
+                rows = leaf_q[lo:lo + step]
+                ids = padded[slot[leaf_n[lo:lo + step]]]
+                distances = metric.block(X[rows][:, None, :], self.all_points[np.maximum(ids, 0)])[:, 0, :]
+                work['distance_evaluations'] += int(np.count_nonzero(ids != -1))
+                found = (ids != -1) & (distances <= kth[rows][:, None])
+                live, column = np.nonzero(found)
+                if len(live):
+                    self._merge_candidates(best_d, best_i, rows[live], ids[live, column], distances[live, column])
+                    kth[rows] = np.minimum(kth[rows], best_d[rows, -1])
+            
+            pair_q, pair_n = pair_q[~at_leaf], pair_n[~at_leaf]
+            if len(pair_q):
+                frontier.append((np.concatenate((pair_q, pair_q)),
+                                 np.concatenate((self.left[pair_n], self.right[pair_n]))))
+        
+        count('KDTree.query', results=int(np.count_nonzero(best_i != -1)), **work)
+        return best_d, best_i
+    
+    def _bound_slack(self, metric):
+        # Factor for box lower bounds tested against block distances: the
+        # two sum their axis terms in different orders, so the box of a
+        # point at exactly the k-th distance can come out a few ulps further
+        return 1 + 64 * np.finfo(metric.dtype).eps
+    
+    def _seed_nodes(self, X, k):
+        # Smallest subtree holding at least k points around each point of X
+        parent = np.full(len(self.left), -1, dtype=np.intp)
+        internal = np.flatnonzero(self.left != -1)
+        parent[self.left[internal]] = internal
+        parent[self.right[internal]] = internal
+        seeds = self._descend(X)
+        active = np.flatnonzero(self.node_size(seeds) < k)
+        while len(active):
+            seeds[active] = parent[seeds[active]]
+            active = active[self.node_size(seeds[active]) < k]
+        return seeds
+    
+    def _kth_bounds(self, X, k, metric):
+        # Upper bound of each query's k-th distance: its k-th distance to
+        # the smallest subtree holding k points around it
+        kth = np.full(len(X), np.inf, dtype=metric.dtype)
+        if self.node_size(self.root) < k:
+            return kth
+        seeds = self._seed_nodes(X, k)
+        width = int(self.node_size(seeds).max())
+        columns = np.arange(width)
+        step = max(1, (1 << 20) // width)
+        for lo in range(0, len(X), step):
+            nodes = seeds[lo:lo + step]
+            ids = self.indices[np.minimum(self.node_start[nodes][:, None] + columns, len(self.indices) - 1)]
+            distances = metric.block(X[lo:lo + step, None, :], self.all_points[ids])[:, 0, :]
+            distances[columns[None, :] >= self.node_size(nodes)[:, None]] = np.inf
+            kth[lo:lo + step] = np.partition(distances, k - 1, axis=1)[:, k - 1]
+        return kth
+    
+    @time_decorator
+    def query_tree(self, other, k=1, metric=None):
+        # k nearest points of this tree for every point of another tree as
+        # CSR-style arrays: the neighbours of other's row i are
+        # indices[indptr[i]:indptr[i + 1]] at distances[indptr[i]:indptr[i + 1]],
+        # nearest first
+        metric = self._metric(metric)
+        if isinstance(other.metric, Cosine) != isinstance(metric, Cosine):
+            raise ValueError("Both trees must be built with the cosine metric to be queried with it")
+        indptr, indices, distances = self._to_csr(*self._dual_knn(other, k, metric, 'KDTree.query_tree'))
+        count('KDTree.query_tree', results=len(indices))
+        return indptr, indices, distances
+    
+    def knn_graph(self, k=1, metric=None):
+        # k nearest other points of every point of the tree, as CSR arrays
+        # over rows of all_points like query_tree
+        metric = self._metric(metric)
+        best_d, best_i = self._dual_knn(self, k + 1, metric, 'KDTree.knn_graph')
+        
+        # Drop every point from its own row.  With duplicates the point need
+        # not come first or be found at all, in which case the row loses its
+        # last entry instead.
+        drop = best_i == np.arange(len(best_i))[:, None]
+        drop[~drop.any(axis=1), -1] = True
+        keep = ~drop
+        best_d = best_d[keep].reshape(len(best_d), k)
+        best_i = best_i[keep].reshape(len(best_i), k)
+        indptr, indices, distances = self._to_csr(best_d, best_i)
+        count('KDTree.knn_graph', results=len(indices))
+        return indptr, indices, distances
+    
+    def _to_csr(self, best_d, best_i):
+        # Row-sorted (m, k) results to CSR arrays without the -1 padding
+        found = best_i != -1
+        indptr = np.zeros(len(best_i) + 1, dtype=np.intp)
+        np.cumsum(np.count_nonzero(found, axis=1), out=indptr[1:])
+        return indptr, self._label(best_i[found]), best_d[found]
+    
+    def _padded_leaves(self):
+        # Leaf ids in preorder and their index slices padded with -1 to the
+        # largest leaf, for gathering many leaf blocks in one NumPy call
+        leaves = np.flatnonzero(self.left == -1)
+        sizes = self.node_end[leaves] - self.node_start[leaves]
+        width = int(sizes.max())
+        columns = np.arange(width)
+        valid = columns[None, :] < sizes[:, None]
+        padded = np.full((len(leaves), width), -1, dtype=np.intp)
+        padded[valid] = self.indices[(self.node_start[leaves][:, None] + columns)[valid]]
+        return leaves, padded
+    
+    def _dual_knn(self, other, k, metric, name):
+        # Walk the leaves of other, each a group of queries, down this tree
+        # together: a (query leaf, node) pair is dropped once the two boxes
+        # are further apart than the k-th distance of every query in the
+        # leaf.  The frontier is tested in chunks of FRONTIER_PAIRS pairs,
+        # walked depth first, and leaf pairs are scanned in stacked blocks
+        # whose points are gathered per block.  The work is counted in the
+        # stats of method name.
+        m = 0 if other.root == -1 else len(other.all_points)
+        best_d = np.full((m, k), np.inf, dtype=metric.dtype)
+        best_i = np.full((m, k), -1, dtype=np.intp)
+        if self.root == -1 or m == 0:
+            return best_d, best_i
+        
+        q_leaves, q_rows = other._padded_leaves()
+        r_leaves, r_ids = self._padded_leaves()
+        r_slot = np.zeros(len(self.left), dtype=np.intp)
+        r_slot[r_leaves] = np.arange(len(r_leaves))
+        # Query leaf of every row of other
+        q_slot = np.empty(m, dtype=np.intp)
+        q_slot[q_rows[q_rows != -1]] = np.nonzero(q_rows != -1)[0]
+        # Elements of the stacked distance blocks computed per NumPy call
+        block = 1 << 20
+        
+        # Upper bound of each query's k-th distance: its k-th distance to the
+        # smallest subtree holding k points around the centre of its leaf
+        kth = np.full(m, np.inf, dtype=metric.dtype)
+        if self.node_size(self.root) >= k:
+            seeds = self._seed_nodes((other.node_mins[q_leaves] + other.node_maxes[q_leaves]) / 2, k)
+            width = int(self.node_size(seeds).max())
+            columns = np.arange(width)
+            step = max(1, block // (q_rows.shape[1] * width))
+            for lo in range(0, len(q_leaves), step):
+                nodes = seeds[lo:lo + step]
+                rows = q_rows[lo:lo + step]
+                ids = self.indices[np.minimum(self.node_start[nodes][:, None] + columns, len(self.indices) - 1)]
+                distances = metric.block(other.all_points[np.maximum(rows, 0)], self.all_points[ids])
+                valid = columns[None, :] < self.node_size(nodes)[:, None]
+                distances = np.where(valid[:, None, :], distances, np.inf)
+                found = rows != -1
+                kth[rows[found]] = np.partition(distances, k - 1, axis=2)[:, :, k - 1][found]
+        
+        slack = self._bound_slack(metric)
+        # Work counters for the stats: (query leaf, node) visits, query-point
+        # distances, and (query leaf, node) pairs dropped
+        work = {'nodes_visited': 0, 'distance_evaluations': 0, 'pruned_subtrees': 0}
+        
+        def _leaf_bounds(leaves):
+            # Largest k-th distance bound of the queries in each of the query
+            # leaves, with the slack box bounds are tested against
+            rows = q_rows[leaves]
+            return np.where(rows != -1, kth[rows], 0.0).max(axis=1) * slack
+            
+        def _gaps(pair_q, pair_r):
+            q_nodes = q_leaves[pair_q]
+            gap = np.maximum(self.node_mins[pair_r] - other.node_maxes[q_nodes],
+                             other.node_mins[q_nodes] - self.node_maxes[pair_r])
+            return metric.reduced(np.maximum(gap, 0.0))
+        
+        bounds = _leaf_bounds(np.arange(len(q_leaves)))
+        step = max(1, block // (q_rows.shape[1] * r_ids.shape[1]))
+        chunk = self.FRONTIER_PAIRS
+        frontier = [(np.arange(len(q_leaves)), np.full(len(q_leaves), self.root, dtype=np.intp))]
+        while frontier:
+            pair_q, pair_r = frontier.pop()
+            if len(pair_q) > chunk:
+                frontier.append((pair_q[chunk:], pair_r[chunk:]))
+                pair_q, pair_r = pair_q[:chunk], pair_r[:chunk]
+            keep = _gaps(pair_q, pair_r) <= bounds[pair_q]
+            work['pruned_subtrees'] += len(keep) - int(np.count_nonzero(keep))
+            pair_q, pair_r = pair_q[keep], pair_r[keep]
+            work['nodes_visited'] += len(pair_q)
+            
+            # Leaf pairs go in order of the distance between their centres,
+            # so the closest leaves tighten the bounds the others are tested
+            # against
+            at_leaf = np.flatnonzero(self.left[pair_r] == -1)
+            q_nodes, r_nodes = q_leaves[pair_q[at_leaf]], pair_r[at_leaf]
+            offset = (self.node_mins[r_nodes] + self.node_maxes[r_nodes]) - (other.node_mins[q_nodes] + other.node_maxes[q_nodes])
+            at_leaf = at_leaf[np.argsort(metric.reduced(offset), kind='stable')]
+            for lo in range(0, len(at_leaf), step):
+                leaf_q = pair_q[at_leaf[lo:lo + step]]
+                leaf_r = pair_r[at_leaf[lo:lo + step]]
+                near = _gaps(leaf_q, leaf_r) <= bounds[leaf_q]
+                work['pruned_subtrees'] += len(near) - int(np.count_nonzero(near))
+                leaf_q, leaf_r = leaf_q[near], leaf_r[near]
+                # Only the queries of a pair within their own k-th distance
+                # of the reference leaf's box are scanned against it
+                rows = q_rows[leaf_q]
+                points = other.all_points[np.maximum(rows, 0)]
+                gap = np.maximum(self.node_mins[leaf_r][:, None, :] - points, points - self.node_maxes[leaf_r][:, None, :])
+                live = (rows != -1) & (metric.reduced(np.maximum(gap, 0.0)) <= kth[rows] * slack)
+                pair, a = np.nonzero(live)
+                if not len(pair):
+                    continue
+                rows = rows[pair, a]
+                ids = r_ids[r_slot[leaf_r]]
+                distances = metric.block(points[pair, a][:, None, :], self.all_points[np.maximum(ids, 0)][pair])[:, 0, :]
+                ids = ids[pair]
+                work['distance_evaluations'] += int(np.count_nonzero(ids != -1))
+                found = (ids != -1) & (distances <= kth[rows][:, None])
+                live, b = np.nonzero(found)
+                if len(live):
+                    rows = rows[live]
+                    self._merge_candidates(best_d, best_i, rows, ids[live, b], distances[live, b])
+                    kth[rows] = np.minimum(kth[rows], best_d[rows, -1])
+                    leaves = np.unique(q_slot[rows])
+                    bounds[leaves] = _leaf_bounds(leaves)
+                
+            inner = self.left[pair_r] != -1
+            pair_q, pair_r = pair_q[inner], pair_r[inner]
+            if len(pair_q):
+                frontier.append((np.concatenate((pair_q, pair_q)),
+                                 np.concatenate((self.left[pair_r], self.right[pair_r]))))
+        
+        count(name, **work)
+        return best_d, best_i
+    
+    def _merge_candidates(self, best_d, best_i, rows, ids, distances):
+        # Fold (query row, point id, distance) candidates into the sorted
+        # k best of each query: the candidates of a row are laid out after
+        # its current k best and the k smallest of the row are kept
+        k = best_d.shape[1]
+        order = np.argsort(rows)
+        rows, ids, distances = rows[order], ids[order], distances[order]
+        starts = np.flatnonzero(np.diff(rows, prepend=-1))
+        counts = np.diff(np.append(starts, len(rows)))
+        affected = rows[starts]
+        group = np.repeat(np.arange(len(affected)), counts)
+        slot = k + np.arange(len(rows)) - starts[group]
+        
+        cand_d = np.full((len(affected), k + counts.max()), np.inf, dtype=best_d.dtype)
+        cand_i = np.full(cand_d.shape, -1, dtype=np.intp)
+        cand_d[:, :k] = best_d[affected]
+        cand_i[:, :k] = best_i[affected]
+        cand_d[group, slot] = distances
+        cand_i[group, slot] = ids
+        keep = np.argpartition(cand_d, k - 1, axis=1)[:, :k]
+        cand_d = np.take_along_axis(cand_d, keep, axis=1)
+        cand_i = np.take_along_axis(cand_i, keep, axis=1)
+        order = np.argsort(cand_d, axis=1)
+        best_d[affected] = np.take_along_axis(cand_d, order, axis=1)
+        best_i[affected] = np.take_along_axis(cand_i, order, axis=1)
+    
+    @time_decorator
+    def query_pairs(self, r, metric=None):
+        # Every pair of points of the tree within distance r of each other,
+        # as two arrays i, j with i < j (row order, labels are reported)
+        metric = self._metric(metric)
+        rows, ids, _ = self._dual_radius(self, metric.from_distance(r), metric, True, False, 'KDTree.query_pairs')
+        count('KDTree.query_pairs', results=len(rows))
+        i, j = np.minimum(rows, ids), np.maximum(rows, ids)
+        return self._label(i), self._label(j)
+    
+    @time_decorator
+    def sparse_distance_matrix(self, other, r, metric=None):
+        # Every pair of a point of this tree and a point of another tree
+        # within distance r, in coordinate form: point i[n] of this tree and
+        # j[n] of other are distances[n] apart (reduced, like all distances)
+        metric = self._metric(metric)
+        if isinstance(other.metric, Cosine) != isinstance(metric, Cosine):
+            raise ValueError("Both trees must be built with the cosine metric to be queried with it")
+        rows, ids, distances = self._dual_radius(other, metric.from_distance(r), metric, False, True,
+                                                 'KDTree.sparse_distance_matrix')
+        count('KDTree.sparse_distance_matrix', results=len(rows))
+        return self._label(ids), other._label(rows), distances
+    
+    def _dual_radius(self, other, radius, metric, self_join, with_distances, name):
+        # Walk the leaves of other down this tree as in _dual_knn with a
+        # fixed bound, or their single points where leaf boxes prune poorly.
+        # A pair whose boxes are entirely within radius of each other
+        # matches whole, and unless distances are wanted its points are
+        # paired without computing any.  With self_join each unordered
+        # pair is produced once, by its first point in tree order.  Returns
+        # rows of other, rows of this tree and distances (None without), and
+        # counts the work in the stats of method name.
+        size = 0
+        out_rows = np.empty(1024, dtype=np.intp)
+        out_ids = np.empty(1024, dtype=np.intp)
+        out_d = np.empty(1024, dtype=metric.dtype) if with_distances else None
+        # Work counters for the stats: (query leaf or point, node) visits,
+        # point distances, and pairs dropped
+        work = {'nodes_visited': 0, 'distance_evaluations': 0, 'pruned_subtrees': 0}
+        
+        def _append(rows, ids, distances):
+            # Write matches into the output arrays, doubling them when full
+            nonlocal size, out_rows, out_ids, out_d
+            end = size + len(rows)
+            if end > len(out_rows):
+                capacity = max(end, 2 * len(out_rows))
+                out_rows = np.resize(out_rows, capacity)
+                out_ids = np.resize(out_ids, capacity)
+                if with_distances:
+                    out_d = np.resize(out_d, capacity)
+            out_rows[size:end] = rows
+            out_ids[size:end] = ids
+            if with_distances:
+                out_d[size:end] = distances
+            size = end
+        
+        if self.root != -1 and other.root != -1:
+            q_leaves, q_rows = other._padded_leaves()
+            r_leaves, r_ids = self._padded_leaves()
+            r_slot = np.zeros(len(self.left), dtype=np.intp)
+            r_slot[r_leaves] = np.arange(len(r_leaves))
+            r_columns = np.arange(r_ids.shape[1])
+            if self_join:
+                # Position of every row in tree order
+                position = np.empty(len(self.indices), dtype=np.intp)
+                position[self.indices] = np.arange(len(self.indices))
+            bound = radius * self._bound_slack(metric)
+            step = max(1, (1 << 20) // (q_rows.shape[1] * r_ids.shape[1]))
+            scan_rows = max(1, (1 << 20) // (r_ids.shape[1] * self.k))
+            chunk = self.FRONTIER_PAIRS
+            
+            def _scan(rows, leaf_r):
+                # Match points of other against the points of one reference
+                # leaf each, in blocks of scan_rows
+                for lo in range(0, len(rows), scan_rows):
+                    block_rows, block_r = rows[lo:lo + scan_rows], leaf_r[lo:lo + scan_rows]
+                    # Points of each distinct leaf are gathered once
+                    slots, slot_of = np.unique(r_slot[block_r], return_inverse=True)
+                    ids = r_ids[slots]
+                    distances = metric.block(other.all_points[block_rows][:, None, :],
+                                             self.all_points[np.maximum(ids, 0)][slot_of])[:, 0, :]
+                    ids = ids[slot_of]
+                    work['distance_evaluations'] += int(np.count_nonzero(ids != -1))
+                    found = (ids != -1) & (distances <= radius)
+                    if self_join:
+                        # Each pair once, from its first point in tree order
+                        found &= position[block_rows][:, None] < self.node_start[block_r][:, None] + r_columns
+                    live, b = np.nonzero(found)
+                    _append(block_rows[live], ids[live, b], distances[live, b] if with_distances else None)
+                    
+            def _take_whole(rows, nodes):
+                # Pair each row of other with every point below its node
+                sizes = self.node_size(nodes)
+                offsets = np.repeat(self.node_start[nodes] - np.cumsum(sizes) + sizes, sizes)
+                _append(np.repeat(rows, sizes), self.indices[offsets + np.arange(offsets.size)], None)
                 
-            search_path.append(node)
+            def _children(pair_a, pair_r):
+                return (np.concatenate((pair_a, pair_a)), np.concatenate((self.left[pair_r], self.right[pair_r])))
                 
-            # Check if the current point is within the range
-            if np.all(lower_bound <= node.point) and np.all(node.point <= upper_bound):
-                result.append(node.point)
+            def _leaf_pairs(pair_q, pair_r):
+                # (query leaf, node) pairs: returns the pairs of the next level
+                q_nodes = q_leaves[pair_q]
+                q_min, q_max = other.node_mins[q_nodes], other.node_maxes[q_nodes]
+                r_min, r_max = self.node_mins[pair_r], self.node_maxes[pair_r]
+                keep = metric.reduced(np.maximum(np.maximum(r_min - q_max, q_min - r_max), 0.0)) <= bound
+                if self_join:
+                    # Subtrees wholly before the query leaf were paired already
+                    keep &= self.node_end[pair_r] > other.node_start[q_nodes]
+                work['pruned_subtrees'] += len(keep) - int(np.count_nonzero(keep))
+                pair_q, pair_r = pair_q[keep], pair_r[keep]
+                work['nodes_visited'] += len(pair_q)
+                q_nodes = q_leaves[pair_q]
+                
+                whole = np.zeros(len(pair_q), dtype=bool)
+                if not with_distances:
+                    far = np.maximum(self.node_maxes[pair_r] - other.node_mins[q_nodes],
+                                     other.node_maxes[q_nodes] - self.node_mins[pair_r])
+                    whole = metric.reduced(far) <= radius
+                    if self_join:
+                        whole &= self.node_start[pair_r] >= other.node_end[q_nodes]
+                    rows = q_rows[pair_q[whole]]
+                    valid = rows != -1
+                    _take_whole(rows[valid], np.broadcast_to(pair_r[whole][:, None], rows.shape)[valid])
+                    
+                at_leaf = np.flatnonzero((self.left[pair_r] == -1) & ~whole)
+                for lo in range(0, len(at_leaf), step):
+                    leaf_q = pair_q[at_leaf[lo:lo + step]]
+                    leaf_r = pair_r[at_leaf[lo:lo + step]]
+                    # Only the query points within radius of the reference
+                    # leaf's box are scanned against its points
+                    rows = q_rows[leaf_q]
+                    points = other.all_points[np.maximum(rows, 0)]
+                    gap = np.maximum(self.node_mins[leaf_r][:, None, :] - points, points - self.node_maxes[leaf_r][:, None, :])
+                    pair, a = np.nonzero((rows != -1) & (metric.reduced(np.maximum(gap, 0.0)) <= bound))
+                    _scan(rows[pair, a], leaf_r[pair])
+                    
+                inner = (self.left[pair_r] != -1) & ~whole
+                return _children(pair_q[inner], pair_r[inner])
+                
+            def _point_pairs(pair_p, pair_r):
+                # (row of other, node) pairs: returns the point pairs of the
+                # next level
+                points = other.all_points[pair_p]
+                lo, hi = self.node_mins[pair_r], self.node_maxes[pair_r]
+                keep = metric.reduced(np.maximum(np.maximum(lo - points, points - hi), 0.0)) <= bound
+                if self_join:
+                    keep &= self.node_end[pair_r] > position[pair_p] + 1
+                work['pruned_subtrees'] += len(keep) - int(np.count_nonzero(keep))
+                pair_p, pair_r, points = pair_p[keep], pair_r[keep], points[keep]
+                work['nodes_visited'] += len(pair_p)
+                
+                whole = np.zeros(len(pair_p), dtype=bool)
+                if not with_distances:
+                    far = np.maximum(points - self.node_mins[pair_r], self.node_maxes[pair_r] - points)
+                    whole = metric.reduced(far) <= radius
+                    if self_join:
+                        whole &= self.node_start[pair_r] > position[pair_p]
+                    _take_whole(pair_p[whole], pair_r[whole])
+                at_leaf = (self.left[pair_r] == -1) & ~whole
+                _scan(pair_p[at_leaf], pair_r[at_leaf])
+                inner = (self.left[pair_r] != -1) & ~whole
+                return _children(pair_p[inner], pair_r[inner])
             
-            # Check if the left subtree needs to be searched
-            if node.left is not None and lower_bound[node.axis] <= node.point[node.axis]:
-                _search(node.left)
+            # A box test between two leaves only prunes well along the axes
+            # where the query leaf is narrower than the radius.  Query leaves
+            # wide along more than DUAL_WIDE_AXES axes, as in high intrinsic
+            # dimension, walk down as their single points instead.
+            widths = other.node_maxes[q_leaves] - other.node_mins[q_leaves]
+            wide = sum(metric.axis_terms(widths[:, axis], axis) > radius for axis in range(other.k))
+            split = wide > self.DUAL_WIDE_AXES
+            rows = q_rows[split]
+            rows = rows[rows != -1]
+            leaves = np.flatnonzero(~split)
+            
+            # Both kinds of pairs are tested in chunks of FRONTIER_PAIRS and
+            # walked depth first
+            frontier = [(True, rows, np.full(len(rows), self.root, dtype=np.intp)),
+                        (False, leaves, np.full(len(leaves), self.root, dtype=np.intp))]
+            while frontier:
+                single, pair_a, pair_r = frontier.pop()
+                if len(pair_a) > chunk:
+                    frontier.append((single, pair_a[chunk:], pair_r[chunk:]))
+                    pair_a, pair_r = pair_a[:chunk], pair_r[:chunk]
+                pair_a, pair_r = _point_pairs(pair_a, pair_r) if single else _leaf_pairs(pair_a, pair_r)
+                if len(pair_a):
+                    frontier.append((single, pair_a, pair_r))
+        
+        count(name, **work)
+        return out_rows[:size], out_ids[:size], out_d[:size] if with_distances else None
+    
+    @time_decorator
+    def query_ball_point(self, X, r, workers=1, metric=None, return_length=False):
+        # r is a true distance, not a reduced one; with return_length only
+        # the number of points in each ball is returned
+        if not isinstance(X, np.ndarray):
+            X = np.array(X)
+        single = X.ndim == 1
+        metric = self._metric(metric)
+        X = metric.prepare_queries(np.atleast_2d(X))
+        radius = np.broadcast_to(metric.from_distance(np.asarray(r, dtype=np.float64)), (len(X),))
+        
+        result = self._map_chunks('_query_ball_point', workers, (X, radius), (metric, return_length), X)
+        if return_length:
+            return int(result[0]) if single else result
+        result = [self._label(ids) for ids in result]
+        return result[0] if single else result
+    
+    def _query_ball_point(self, X, radius, metric, return_length=False):
+        m = len(X)
+        counts = np.zeros(m, dtype=np.intp)
+        query_parts, id_parts = [], []
+        work = {'nodes_visited': 0, 'distance_evaluations': 0, 'pruned_subtrees': 0}  # for the stats
+        
+        def _search(node, queries):
+            work['nodes_visited'] += 1
+            Xq = X[queries]
+            near, far = self._box_gaps(node, Xq)
+            queries_radius = radius[queries]
+            reach = metric.reduced(near) <= queries_radius
+            work['pruned_subtrees'] += len(reach) - int(np.count_nonzero(reach))
+            # Queries whose ball holds the node's whole box take all of its
+            # points without computing distances
+            inside = reach & (metric.reduced(far) <= queries_radius)
+            if np.any(inside):
+                if return_length:
+                    counts[queries[inside]] += self.node_size(node)
+                else:
+                    ids = self._leaf_ids(node)
+                    query_parts.append(np.repeat(queries[inside], len(ids)))
+                    id_parts.append(np.tile(ids, np.count_nonzero(inside)))
+            queries = queries[reach & ~inside]
+            if not len(queries):
+                return
                 
-            # Check if the right subtree needs to be searched
-            if node.right is not None and upper_bound[node.axis] >= node.point[node.axis]:
-                _search(node.right)
+            if self.is_leaf(node):
+                ids = self._leaf_ids(node)
+                work['distance_evaluations'] += len(queries) * len(ids)
+                matches = metric.block(X[queries], self.all_points[ids]) <= radius[queries, None]
+                if return_length:
+                    counts[queries] += np.count_nonzero(matches, axis=1)
+                else:
+                    rows, cols = np.nonzero(matches)
+                    query_parts.append(queries[rows])
+                    id_parts.append(ids[cols])
+                return
+                
+            _search(self.left[node], queries)
+            _search(self.right[node], queries)
         
-        _search(self.root)
-        return result, search_path
+        if self.root != -1 and m:
+            _search(self.root, np.arange(m))
+        if return_length:
+            count('KDTree.query_ball_point', results=int(counts.sum()), **work)
+            return counts
+        count('KDTree.query_ball_point', results=sum(len(part) for part in id_parts), **work)
+        return self._group_pairs(m, query_parts, id_parts)
+    
+    @time_decorator
+    def query_range(self, lower_bounds, upper_bounds, workers=1):
+        if not isinstance(lower_bounds, np.ndarray):
+            lower_bounds = np.array(lower_bounds)
+        if not isinstance(upper_bounds, np.ndarray):
+            upper_bounds = np.array(upper_bounds)
+        single = lower_bounds.ndim == 1
+        lower_bounds = np.atleast_2d(lower_bounds)
+        upper_bounds = np.atleast_2d(upper_bounds)
+        if not np.all(lower_bounds <= upper_bounds):
+            raise ValueError("Invalid range: lower_bound must be less than or equal to upper_bound in all dimensions")
+        
+        centres = (lower_bounds + upper_bounds) / 2
+        result = self._map_chunks('_query_range', workers, (lower_bounds, upper_bounds), (), centres)
+        result = [self._label(ids) for ids in result]
+        return result[0] if single else result
+    
+    def _query_range(self, lower_bounds, upper_bounds):
+        m = len(lower_bounds)
+        query_parts, id_parts = [], []
+        work = {'nodes_visited': 0, 'distance_evaluations': 0, 'pruned_subtrees': 0}  # for the stats
+        
+        def _search(node, boxes):
+            work['nodes_visited'] += 1
+            left = lefts[node]
+            if left == -1:
+                ids = self.indices[starts[node]:ends[node]]
+                points = self.all_points[ids]
+                work['distance_evaluations'] += len(boxes) * len(ids)
+                inside = np.ones((len(boxes), len(ids)), dtype=bool)
+                for axis in range(self.k):
+                    inside &= lower_bounds[boxes, axis, None] <= points[None, :, axis]
+                    inside &= points[None, :, axis] <= upper_bounds[boxes, axis, None]
+                rows, cols = np.nonzero(inside)
+                query_parts.append(boxes[rows])
+                id_parts.append(ids[cols])
+                return
+                
+            axis = dims[node]
+            lower, upper = lower_bounds[boxes, axis], upper_bounds[boxes, axis]
+            # Query boxes holding the node's whole box take all of its
+            # points.  The test is skipped where it cannot pay off: above
+            # leaves, which are scanned cheaply anyway, and at nodes wider
+            # along their split axis than every query box.  The split axis
+            # alone then rules most boxes out before the full test.
+            if lefts[left] != -1 and box_hi[node] - box_lo[node] <= widest[axis]:
+                inside = (lower <= box_lo[node]) & (box_hi[node] <= upper)
+                if inside.any():
+                    tested = np.flatnonzero(inside)
+                    inside[tested] = np.all((lower_bounds[boxes[tested]] <= self.node_mins[node]) &
+                                            (self.node_maxes[node] <= upper_bounds[boxes[tested]]), axis=1)
+                    if inside.any():
+                        ids = self.indices[starts[node]:ends[node]]
+                        query_parts.append(np.repeat(boxes[inside], len(ids)))
+                        id_parts.append(np.tile(ids, np.count_nonzero(inside)))
+                        outside = ~inside
+                        boxes, lower, upper = boxes[outside], lower[outside], upper[outside]
+                        if not len(boxes):
+                            return
+                            
+            split = splits[node]
+            left_boxes = boxes[lower <= split]
+            if len(left_boxes):
+                _search(left, left_boxes)
+            right_boxes = boxes[upper >= split]
+            if len(right_boxes):
+                _search(rights[node], right_boxes)
+            work['pruned_subtrees'] += 2 * len(boxes) - len(left_boxes) - len(right_boxes)
+        
+        if self.root != -1 and m:
+            if self._left_list is None:
+                self._refresh_caches()
+            lefts, rights = self._left_list, self._right_list
+            dims, splits = self._dims_list, self._splits_list
+            starts, ends = self._start_list, self._end_list
+            box_lo, box_hi = self._box_lo_list, self._box_hi_list
+            widest = (upper_bounds - lower_bounds).max(axis=0).tolist()  # per axis, over the query boxes
+            _search(self.root, np.arange(m))
+        count('KDTree.query_range', results=sum(len(part) for part in id_parts), **work)
+        return self._group_pairs(m, query_parts, id_parts)
+    
+    # Fields that, together with the arrays, fully describe a built tree
+    SAVED_FIELDS = ('k', 'leaf_size', 'presort', 'variance_sample', 'root', 'n_nodes')
+    
+    def save(self, path):
+        if self.root == -1:
+            raise ValueError("Cannot save an empty KD-Tree")
+        arrays = {'all_points': self.all_points, 'indices': self.indices,
+                  'node_mins': self.node_mins, 'node_maxes': self.node_maxes}
+        arrays.update((name, getattr(self, name)) for name in self.NODE_ARRAYS)
+        if self.ids is not None:
+            if self.ids.dtype.hasobject:
+                raise ValueError("Only fixed-size ids can be saved")
+            arrays['ids'] = self.ids
+        
+        # Array offsets are relative to the first aligned byte after the header
+        layout = {}
+        offset = 0
+        for name, array in arrays.items():
+            layout[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+            offset = _aligned(offset + array.nbytes)
+        header = {field: getattr(self, field) for field in self.SAVED_FIELDS}
+        header['metric'] = self.metric.spec()
+        header['arrays'] = layout
+        header = json.dumps(header, default=int).encode('utf-8')
+        
+        with open(path, 'wb') as f:
+            f.write(FILE_MAGIC)
+            f.write(struct.pack('<II', FILE_VERSION, len(header)))
+            f.write(header)
+            data_start = _aligned(f.tell())
+            for name, array in arrays.items():
+                f.seek(data_start + layout[name]['offset'])
+                np.ascontiguousarray(array).tofile(f)
+    
+    @classmethod
+    def load(cls, path, mmap=True, cache_size=0, cache_bytes=None, list_caches=True):
+        # With mmap the arrays are read-only views of the file, so every
+        # process that loads the same file shares one copy in the page cache.
+        # The single-point queries still copy the node arrays into Python
+        # lists of their own on first use, several times the size of the
+        # arrays in every process; list_caches=False has them index the
+        # mapped arrays instead, which keeps the memory shared at the price
+        # of slower single-point queries.
+        with open(path, 'rb') as f:
+            if f.read(len(FILE_MAGIC)) != FILE_MAGIC:
+                raise ValueError(f"{path} is not a KD-Tree file")
+            version, header_length = struct.unpack('<II', f.read(8))
+            if version != FILE_VERSION:
+                raise ValueError(f"Unsupported KD-Tree file version {version}")
+            header = json.loads(f.read(header_length).decode('utf-8'))
+            data_start = _aligned(f.tell())
+            
+            arrays = {}
+            for name, spec in header.pop('arrays').items():
+                dtype = np.dtype(spec['dtype'])
+                shape = tuple(spec['shape'])
+                if mmap:
+                    arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=data_start + spec['offset'], shape=shape)
+                else:
+                    f.seek(data_start + spec['offset'])
+                    arrays[name] = np.fromfile(f, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+        
+        tree = cls.__new__(cls)
+        for field in cls.SAVED_FIELDS:
+            setattr(tree, field, header[field])
+        # Files written before metrics existed hold Euclidean trees
+        tree.metric = get_metric(header.get('metric'))
+        tree.ids = arrays.pop('ids', None)
+        tree.result_cache = QueryCache(cache_size, cache_bytes) if cache_size else None
+        for name, array in arrays.items():
+            setattr(tree, name, array)
+        if 'node_mins' not in arrays:
+            tree._compute_boxes()
+        # The list caches are built on the first single-point query
+        tree._left_list = None
+        if not list_caches:
+            tree._refresh_caches(lists=False)
+        return tree
     
     def visualize_tree(self, bounds=None, ax=None, depth=0, node=None):
         if self.k != 2:
@@ -208,55 +1629,59 @@ class KDTree:
             # Plot all points
             ax.scatter(self.all_points[:, 0], self.all_points[:, 1], c='red', s=30, label='Points')
             
-        if node is None:
+        if node == -1:
             return
             
-        # Draw the splitting line
-        axis = node.axis
-        if axis == 0:  # Vertical line (split on x-axis)
-            y_min = bounds[1]
-            y_max = bounds[3]
-            if y_max <= y_min:
-                # get the global y bounds
-                y_min -= 0.5
-                y_max += 0.5
-                # Add padding
-                padding = (y_max - y_min) * 0.1
-                y_min -= padding
-                y_max += padding
-            ax.plot([node.point[0], node.point[0]], [y_min, y_max], 'r-', alpha=0.5)
-            
-            # Recurse to left and right subtrees with updated bounds
-            if node.left:
-                new_bounds = (bounds[0], bounds[1], node.point[0], bounds[3])
-                self.visualize_tree(new_bounds, ax, depth + 1, node.left)
-            if node.right:
-                new_bounds = (node.point[0], bounds[1], bounds[2], bounds[3])
-                self.visualize_tree(new_bounds, ax, depth + 1, node.right)
-                
-        else:  # Horizontal line (split on y-axis)
-            x_min = bounds[0]
-            x_max = bounds[2]
-            if x_max <= x_min:
-                # get the global x bounds
-                x_min -= 0.5
-                x_max += 0.5
-                # Add padding
-                padding = (x_max - x_min) * 0.1
-                x_min -= padding
-                x_max += padding
-            ax.plot([x_min, x_max], [node.point[1], node.point[1]], 'g-', alpha=0.5)
-            
-            # Recurse to left and right subtrees with updated bounds
-            if node.left:
-                new_bounds = (bounds[0], bounds[1], bounds[2], node.point[1])
-                self.visualize_tree(new_bounds, ax, depth + 1, node.left)
-            if node.right:
-                new_bounds = (bounds[0], node.point[1], bounds[2], bounds[3])
-                self.visualize_tree(new_bounds, ax, depth + 1, node.right)
+        if self.is_leaf(node):
+            # Highlight the points of this leaf bucket
+            points = self.node_points(node)
+            ax.scatter(points[:, 0], points[:, 1], c='red', s=50)
+        else:
+            # Draw the splitting line
+            axis = self.split_dims[node]
+            split = self.split_values[node]
+            left, right = self.left[node], self.right[node]
+            if axis == 0:  # Vertical line (split on x-axis)
+                y_min = bounds[1]
+                y_max = bounds[3]
+                if y_max <= y_min:
+                    # get the global y bounds
+                    y_min -= 0.5
+                    y_max += 0.5
+                    # Add padding
+                    padding = (y_max - y_min) * 0.1
+                    y_min -= padding
+                    y_max += padding
+                ax.plot([split, split], [y_min, y_max], 'r-', alpha=0.5)
+            
+                # Recurse to left and right subtrees with updated bounds
+                if left != -1:
+                    new_bounds = (bounds[0], bounds[1], split, bounds[3])
+                    self.visualize_tree(new_bounds, ax, depth + 1, left)
+                if right != -1:
+                    new_bounds = (split, bounds[1], bounds[2], bounds[3])
+                    self.visualize_tree(new_bounds, ax, depth + 1, right)
                 
-        # Highlight this node
-        ax.scatter(node.point[0], node.point[1], c='red', s=50)
+            else:  # Horizontal line (split on y-axis)
+                x_min = bounds[0]
+                x_max = bounds[2]
+                if x_max <= x_min:
+                    # get the global x bounds
+                    x_min -= 0.5
+                    x_max += 0.5
+                    # Add padding
+                    padding = (x_max - x_min) * 0.1
+                    x_min -= padding
+                    x_max += padding
+                ax.plot([x_min, x_max], [split, split], 'g-', alpha=0.5)
+            
+                # Recurse to left and right subtrees with updated bounds
+                if left != -1:
+                    new_bounds = (bounds[0], bounds[1], bounds[2], split)
+                    self.visualize_tree(new_bounds, ax, depth + 1, left)
+                if right != -1:
+                    new_bounds = (bounds[0], split, bounds[2], bounds[3])
+                    self.visualize_tree(new_bounds, ax, depth + 1, right)
             
         if depth == 0:  # Only for the initial call
             ax.set_xlim(bounds[0], bounds[2])
@@ -282,7 +1707,7 @@ class KDTree:
         self.visualize_tree(ax=ax)
         
         # Perform nearest neighbor search and get the search path
-        (nearest_point, distance), search_path = self.nearest_neighbor(query_point)
+        (nearest_point, distance), search_path = self.nearest_neighbor(query_point, trace=True, return_points=True)
         print(f"Nearest point to {query_point} is {nearest_point} with distance {np.sqrt(distance):.2f}")
         
         # Plot query point
@@ -301,7 +1726,9 @@ class KDTree:
         # Highlight the search path
         for i, node in enumerate(search_path):
             alpha = 0.3 + 0.7 * (i / len(search_path))  # Fade in nodes visited later
-            ax.scatter(node.point[0], node.point[1], c='green', s=70, alpha=alpha, edgecolors='black')
+            if self.is_leaf(node):
+                points = self.node_points(node)
+                ax.scatter(points[:, 0], points[:, 1], c='green', s=70, alpha=alpha, edgecolors='black')
             
         ax.set_title(f'Nearest Neighbor Search for {query_point}')
         ax.legend()
@@ -322,7 +1749,7 @@ class KDTree:
         self.visualize_tree(ax=ax)
         
         # Perform k nearest neighbors search and get the search path
-        k_nearest, search_path = self.k_nearest_neighbors(query_point, k)
+        k_nearest, search_path = self.k_nearest_neighbors(query_point, k, trace=True, return_points=True)
         print(f"{k} nearest points to {query_point}:")
         for i, (point, dist) in enumerate(k_nearest):
             print(f"{i+1}: {point} with distance {np.sqrt(dist):.2f}")
@@ -345,7 +1772,9 @@ class KDTree:
         # Highlight the search path
         for i, node in enumerate(search_path):
             alpha = 0.3 + 0.7 * (i / len(search_path))  # Fade in nodes visited later
-            ax.scatter(node.point[0], node.point[1], c='green', s=70, alpha=alpha, edgecolors='black')
+            if self.is_leaf(node):
+                points = self.node_points(node)
+                ax.scatter(points[:, 0], points[:, 1], c='green', s=70, alpha=alpha, edgecolors='black')
             
         ax.set_title(f'{k} Nearest Neighbors Search for {query_point}')
         ax.legend()
@@ -368,7 +1797,7 @@ class KDTree:
         self.visualize_tree(ax=ax)
         
         # Perform range search and get the search path
-        points_in_range, search_path = self.range_search(lower_bound, upper_bound)
+        points_in_range, search_path = self.range_search(lower_bound, upper_bound, trace=True, return_points=True)
         print(f"Points in range {lower_bound} to {upper_bound}:")
         for point in points_in_range:
             print(f"{point}")
@@ -387,7 +1816,9 @@ class KDTree:
         # Highlight the search path
         for i, node in enumerate(search_path):
             alpha = 0.3 + 0.7 * (i / len(search_path))  # Fade in nodes visited later
-            ax.scatter(node.point[0], node.point[1], c='green', s=70, alpha=alpha, edgecolors='black')
+            if self.is_leaf(node):
+                points = self.node_points(node)
+                ax.scatter(points[:, 0], points[:, 1], c='green', s=70, alpha=alpha, edgecolors='black')
             
         ax.set_title(f'Range Search from {lower_bound} to {upper_bound}')
         ax.legend()
@@ -395,20 +1826,21 @@ class KDTree:
         return ax
     
     def __str__(self):
-        if self.root is None:
+        if self.root == -1:
             return "Empty KD-Tree"
             
         result = []
         
         def _traverse(node, depth=0, prefix="Root: "):
-            if node is None:
+            indent = "  " * depth
+            if self.is_leaf(node):
+                result.append(f"{indent}{prefix}{self.node_points(node).tolist()}")
                 return
                 
-            indent = "  " * depth
-            result.append(f"{indent}{prefix}{node.point} (axis={node.axis})")
+            result.append(f"{indent}{prefix}split={self.split_values[node]} (axis={self.split_dims[node]})")
             
-            _traverse(node.left, depth + 1, "L: ")
-            _traverse(node.right, depth + 1, "R: ")
+            _traverse(self.left[node], depth + 1, "L: ")
+            _traverse(self.right[node], depth + 1, "R: ")
             
         _traverse(self.root)
         return "\n".join(result)
\ No newline at end of file
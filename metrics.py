@@ -0,0 +1,163 @@
+import numpy as np
+
+class Minkowski:
+
+    # Weighted Minkowski distance (sum_i w_i |x_i - y_i|^p)^(1/p), or
+    # max_i w_i |x_i - y_i| for p = inf.  Searches work on the reduced form
+    # without the outer root (the max itself for p = inf): it orders points
+    # the same way, and for p = 2 it is the squared distance used throughout
+    # the trees.  A single axis gap is always a lower bound of the reduced
+    # distance, which is what makes plane pruning valid for every p.
+    # Distances are computed in dtype whatever the points are stored as;
+    # float32 halves the bandwidth of the vectorized kernels at the cost of
+    # precision, and float64 is the default.
+
+    def __init__(self, p=2, weights=None, dtype=np.float64):
+        if p < 1:
+            raise ValueError("Minkowski p must be at least 1")
+        self.p = float(p)
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in (np.float32, np.float64):
+            raise ValueError("Metric dtype must be float32 or float64")
+        if weights is not None:
+            weights = np.asarray(weights, dtype=self.dtype)
+            if np.any(weights < 0):
+                raise ValueError("Metric weights must be non-negative")
+        self.weights = weights
+        self._weights_list = None if weights is None else weights.tolist()
+        self.is_euclidean = self.p == 2 and weights is None
+
+    def __repr__(self):
+        return f"Minkowski(p={self.p}, weights={self.weights}, dtype={self.dtype})"
+
+    def _power(self, gap):
+        if self.p == 2:
+            return gap * gap
+        if self.p == 1 or self.p == np.inf:
+            return gap
+        return gap ** self.p
+
+    def reduced(self, diff):
+        # Reduced distance of difference vectors along the last axis
+        terms = self._power(np.abs(diff).astype(self.dtype, copy=False))
+        if self.weights is not None:
+            terms = terms * self.weights
+        if self.p == np.inf:
+            return np.max(terms, axis=-1)
+        return np.sum(terms, axis=-1)
+
+    def axis_term(self, gap, axis):
+        # Reduced distance of a gap along a single axis
+        term = self._power(abs(gap))
+        if self._weights_list is not None:
+            term = term * self._weights_list[axis]
+        return term
+
+    def axis_terms(self, gaps, axis):
+        # Vectorized axis_term for an array of gaps
+        term = self._power(np.abs(gaps).astype(self.dtype, copy=False))
+        if self.weights is not None:
+            term = term * self.weights[axis]
+        return term
+
+    def block(self, X, points):
+        # (len(X), len(points)) reduced distances, one pass per axis to keep
+        # the temporaries small; leading axes of X and points broadcast, so
+        # (p, m, k) and (p, n, k) stacks give (p, m, n) blocks
+        distances = np.zeros(np.broadcast_shapes(X.shape[:-2], points.shape[:-2]) + (X.shape[-2], points.shape[-2]),
+                             dtype=self.dtype)
+        for axis in range(X.shape[-1]):
+            terms = self.axis_terms(X[..., :, axis, None] - points[..., None, :, axis], axis)
+            if self.p == np.inf:
+                np.maximum(distances, terms, out=distances)
+            else:
+                distances += terms
+        return distances
+
+    def from_distance(self, r):
+        # Reduced form of a true distance, e.g. a search radius
+        if self.p == 1 or self.p == np.inf:
+            return r
+        return r ** self.p
+
+    def to_distance(self, reduced):
+        if self.p == 1 or self.p == np.inf:
+            return reduced
+        return reduced ** (1.0 / self.p)
+
+    def prepare(self, points):
+        # Transform applied to stored and query points before searching.
+        # Float and signed integer points keep their dtype; others (bool,
+        # unsigned, which would wrap on subtraction) become float64.
+        points = np.asarray(points)
+        if points.dtype.kind not in 'fi':
+            points = points.astype(np.float64)
+        return points
+
+    def prepare_queries(self, X):
+        # Queries go to the distance dtype once, so that differences with
+        # float32 points stay in float32 and integer points never wrap
+        return self.prepare(X).astype(self.dtype, copy=False)
+
+    def spec(self):
+        # JSON-friendly description, turned back into a metric by get_metric
+        return {'name': 'minkowski', 'p': self.p, 'weights': self._weights_list, 'dtype': self.dtype.name}
+
+
+class Cosine(Minkowski):
+
+    # Cosine distance 1 - cos(x, y) through normalization: on unit vectors
+    # the squared Euclidean distance equals 2 (1 - cos), so the Euclidean
+    # machinery applies unchanged once points and queries are normalized.
+
+    def __init__(self, dtype=np.float64):
+        super().__init__(p=2, dtype=dtype)
+        self.is_euclidean = False
+
+    def __repr__(self):
+        return f"Cosine(dtype={self.dtype})"
+
+    def from_distance(self, r):
+        return 2.0 * r
+
+    def to_distance(self, reduced):
+        return reduced / 2.0
+
+    def prepare(self, points):
+        # Float points stay in their precision, integer ones become float64
+        points = np.asarray(points)
+        if points.dtype.kind != 'f':
+            points = points.astype(np.float64)
+        norms = np.linalg.norm(points, axis=-1, keepdims=True)
+        return points / np.where(norms == 0, 1.0, norms)
+
+    def spec(self):
+        return {'name': 'cosine', 'dtype': self.dtype.name}
+
+
+METRIC_NAMES = {
+    'euclidean': 2, 'l2': 2,
+    'manhattan': 1, 'cityblock': 1, 'l1': 1,
+    'chebyshev': np.inf, 'linf': np.inf,
+}
+
+def get_metric(metric):
+    # Metric object from a name, a Minkowski p, a spec() dict, or an
+    # existing metric
+    if metric is None:
+        return Minkowski(2)
+    if isinstance(metric, Minkowski):
+        return metric
+    if isinstance(metric, dict):
+        # Specs saved before dtype was recorded are float64
+        dtype = metric.get('dtype', 'float64')
+        if metric['name'] == 'cosine':
+            return Cosine(dtype)
+        return Minkowski(metric['p'], metric['weights'], dtype)
+    if isinstance(metric, str):
+        if metric == 'cosine':
+            return Cosine()
+        if metric not in METRIC_NAMES:
+            raise ValueError(f"Unknown metric {metric!r}")
+        return Minkowski(METRIC_NAMES[metric])
+    return Minkowski(metric)
@@ -1,11 +1,177 @@
 import time
+import json
+import bisect
+import functools
+import threading
+
+# Query instrumentation.  Methods decorated with time_decorator record their
+# latency into stats, and search methods report work counters (nodes
+# visited, distance evaluations, pruned subtrees, result sizes) through
+# count().  Everything is off until enable() is called: the decorated
+# classes then hold the plain methods, so there is no wrapper to pay for,
+# and count() returns at once.  Counters from process-pool workers stay in
+# the workers and are not reported.
+
+LATENCY_BUCKETS = tuple(1e-6 * 4 ** i for i in range(12))  # 1 us .. about 4 s
+SIZE_BUCKETS = tuple(4 ** i for i in range(12))             # 1 .. about 4M
+
+class Histogram:
+
+    # Cumulative-bucket histogram in the Prometheus sense: bucket i counts
+    # the observations <= bounds[i], plus an overflow bucket
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        # (upper bound, observations <= bound) pairs, ending with +Inf
+        total, pairs = 0, []
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+    def to_dict(self):
+        return {'buckets': [[bound, count] for bound, count in self.cumulative()[:-1]],
+                'sum': self.sum, 'count': self.count}
+
+
+class MethodStats:
+
+    def __init__(self):
+        self.calls = 0
+        self.latency = Histogram(LATENCY_BUCKETS)      # seconds per call
+        self.result_size = Histogram(SIZE_BUCKETS)     # results per reported search
+        self.counters = {}                             # counter name -> total
+
+    def to_dict(self):
+        return {'calls': self.calls, 'latency_seconds': self.latency.to_dict(),
+                'result_size': self.result_size.to_dict(), 'counters': dict(self.counters)}
+
+
+class QueryStats:
+
+    def __init__(self):
+        self.enabled = False
+        self.methods = {}  # 'Class.method' -> MethodStats
+        self._lock = threading.Lock()  # batched queries may report from worker threads
+
+    def _method(self, name):
+        method = self.methods.get(name)
+        if method is None:
+            method = self.methods[name] = MethodStats()
+        return method
+
+    def record_call(self, name, seconds):
+        with self._lock:
+            method = self._method(name)
+            method.calls += 1
+            method.latency.observe(seconds)
+
+    def add(self, name, counters):
+        with self._lock:
+            method = self._method(name)
+            if 'results' in counters:
+                method.result_size.observe(counters['results'])
+            for counter, value in counters.items():
+                method.counters[counter] = method.counters.get(counter, 0) + int(value)
+
+    def reset(self):
+        with self._lock:
+            self.methods = {}
+
+    def to_dict(self):
+        with self._lock:
+            return {name: method.to_dict() for name, method in sorted(self.methods.items())}
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), **kwargs)
+
+    def to_prometheus(self, prefix='kdtree'):
+        # Prometheus text exposition format, one series per method
+        snapshot = self.to_dict()
+        lines = []
+
+        def _histogram(metric, key):
+            lines.append(f"# TYPE {prefix}_{metric} histogram")
+            for name, method in snapshot.items():
+                histogram = method[key]
+                for bound, count in histogram['buckets']:
+                    lines.append(f'{prefix}_{metric}_bucket{{method="{name}",le="{bound:g}"}} {count}')
+                lines.append(f'{prefix}_{metric}_bucket{{method="{name}",le="+Inf"}} {histogram["count"]}')
+                lines.append(f'{prefix}_{metric}_sum{{method="{name}"}} {histogram["sum"]:g}')
+                lines.append(f'{prefix}_{metric}_count{{method="{name}"}} {histogram["count"]}')
+
+        lines.append(f"# TYPE {prefix}_calls_total counter")
+        for name, method in snapshot.items():
+            lines.append(f'{prefix}_calls_total{{method="{name}"}} {method["calls"]}')
+        _histogram('latency_seconds', 'latency_seconds')
+        _histogram('result_size', 'result_size')
+        counters = sorted({counter for method in snapshot.values() for counter in method['counters']})
+        for counter in counters:
+            lines.append(f"# TYPE {prefix}_{counter}_total counter")
+            for name, method in snapshot.items():
+                if counter in method['counters']:
+                    lines.append(f'{prefix}_{counter}_total{{method="{name}"}} {method["counters"][counter]}')
+        return '\n'.join(lines) + '\n'
+
+
+stats = QueryStats()
+_timed = []  # (class, attribute, plain method, timing wrapper) per decorated method
+
+def enable():
+    stats.enabled = True
+    for owner, name, func, wrapper in _timed:
+        setattr(owner, name, wrapper)
+
+def disable():
+    stats.enabled = False
+    for owner, name, func, wrapper in _timed:
+        setattr(owner, name, func)
+
+def count(name, **counters):
+    # Add work counters to the stats of method name; 'results' also feeds
+    # the result size histogram
+    if stats.enabled:
+        stats.add(name, counters)
+
+
+class _Timed:
+
+    # Placeholder left in the class body by time_decorator.  Once the class
+    # exists it puts either the plain method or its timing wrapper in its
+    # place and remembers both so enable()/disable() can swap them.
+
+    def __init__(self, func):
+        self.func = func
+        functools.update_wrapper(self, func)
+
+    def __set_name__(self, owner, name):
+        func = self.func
+        label = f"{owner.__name__}.{name}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start_time = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats.record_call(label, time.perf_counter() - start_time)
+
+        _timed.append((owner, name, func, wrapper))
+        setattr(owner, name, wrapper if stats.enabled else func)
+
+    def __call__(self, *args, **kwargs):
+        # Used outside a class body the function is simply not timed
+        return self.func(*args, **kwargs)
 
 def time_decorator(func):
-    def wrapper(*args, **kwargs):
-        start_time = time.time()
-        result = func(*args, **kwargs)
-        end_time = time.time()
-        elapsed_time = end_time - start_time
-        # print(f"function {func.__name__} took {elapsed_time:.4f} seconds")
-        return result
-    return wrapper
\ No newline at end of file
+    return _Timed(func)
@@ -0,0 +1,105 @@
+import numpy as np
+import sys
+import threading
+from collections import OrderedDict
+
+def _nbytes(value):
+    # Rough memory footprint of a cached result: array buffers plus the
+    # containers and scalars around them
+    if isinstance(value, np.ndarray):
+        return value.nbytes + 112
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(_nbytes(item) for item in value)
+    return sys.getsizeof(value)
+
+def copy_result(value):
+    # Copy of a cached result that the caller may modify freely: arrays are
+    # copied and lists rebuilt, tuples and scalars are immutable already
+    if isinstance(value, np.ndarray):
+        return value.copy()
+    if isinstance(value, list):
+        return [copy_result(item) for item in value]
+    return value
+
+class QueryCache:
+
+    # LRU map from query keys to results, bounded by a number of entries
+    # and optionally by the approximate bytes the results take.  The owner
+    # builds the keys, from the query and every argument that changes the
+    # answer, and calls clear() whenever its data changes.  Safe to share
+    # between threads.
+
+    def __init__(self, max_entries=1024, max_bytes=None):
+        if max_entries < 1:
+            raise ValueError("max_entries must be at least 1")
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (result, size), oldest first
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getstate__(self):
+        # A lock can't be pickled, and the cached results would only make
+        # the pickle bigger; the copy starts with an empty cache
+        state = self.__dict__.copy()
+        del state['_lock'], state['_entries']
+        state['bytes'] = 0
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        # (True, result) on a hit, (False, None) on a miss
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[0]
+
+    def put(self, key, result):
+        size = _nbytes(result)
+        with self._lock:
+            # A result bigger than the whole budget would only flush the cache
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._entries[key] = (result, size)
+            self.bytes += size
+            while len(self._entries) > self.max_entries or \
+                  (self.max_bytes is not None and self.bytes > self.max_bytes):
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.bytes -= evicted
+                self.evictions += 1
+
+    def clear(self):
+        # Drop every entry because the data behind them changed
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+            self.invalidations += 1
+
+    def info(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries), 'bytes': self.bytes,
+                'max_entries': self.max_entries, 'max_bytes': self.max_bytes,
+                'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions, 'invalidations': self.invalidations,
+            }
@@ -0,0 +1,227 @@
+import numpy as np
+import asyncio
+import time
+
+class QueryService:
+
+    # asyncio front end for the batched kNN query of a KDTree (or any index
+    # with query(X, k)).  Concurrent requests are queued and coalesced into
+    # one micro-batch until it holds max_batch_size points or max_delay
+    # seconds have passed since its first request; the batch then runs in
+    # an executor, off the event loop, and every caller's future gets its
+    # own rows.  Requests with different k share a batch: the rows come back
+    # sorted by distance, so each caller takes its first k columns.  While a
+    # batch runs the next one is already being collected, with at most
+    # max_pending_batches in flight.
+
+    def __init__(self, tree, max_batch_size=256, max_delay=0.001, executor=None, max_pending_batches=2):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+        self.tree = tree
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.executor = executor  # None = the loop's default thread pool
+        self.max_pending_batches = max_pending_batches
+        self._queue = None
+        self._task = None
+        self._slots = None
+        self._closing = False
+        self.requests = 0
+        self.batches = 0
+        self.batched_points = 0
+
+    async def start(self):
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._slots = asyncio.Semaphore(self.max_pending_batches)
+            self._closing = False
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        return self
+
+    async def close(self):
+        # Answer everything already queued, then stop; queries made from
+        # here on are refused instead of queued behind the stop marker
+        if self._task is not None and not self._closing:
+            self._closing = True
+            self._queue.put_nowait(None)
+        if self._task is not None:
+            await self._task
+            self._task = None
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def info(self):
+        return {'requests': self.requests, 'batches': self.batches, 'batched_points': self.batched_points,
+                'mean_batch_points': self.batched_points / self.batches if self.batches else 0.0}
+
+    async def query(self, X, k=1):
+        # Same result as tree.query(X, k), answered as part of a micro-batch
+        if self._task is None:
+            raise RuntimeError("QueryService is not started")
+        if self._closing:
+            raise RuntimeError("QueryService is closing")
+        if not isinstance(X, np.ndarray):
+            X = np.array(X)
+        single = X.ndim == 1
+        X = np.atleast_2d(X)
+        # Bad requests fail on their own instead of failing a whole batch
+        if k < 1:
+            raise ValueError("k must be at least 1")
+        if getattr(self.tree, 'k', X.shape[1]) != X.shape[1]:
+            raise ValueError(f"Query points must have {self.tree.k} dimensions")
+
+        future = asyncio.get_running_loop().create_future()
+        self.requests += 1
+        self._queue.put_nowait((X, k, future))
+        distances, ids = await future
+        if single:
+            return distances[0], ids[0]
+        return distances, ids
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        running = set()
+        closing = False
+        while not closing:
+            request = await self._queue.get()
+            if request is None:
+                break
+            batch = [request]
+            size = len(request[0])
+            deadline = loop.time() + self.max_delay
+            while size < self.max_batch_size:
+                # Take whatever is queued already, then wait out the delay
+                try:
+                    request = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        request = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if request is None:
+                    closing = True
+                    break
+                batch.append(request)
+                size += len(request[0])
+
+            await self._slots.acquire()
+            task = loop.create_task(self._execute(batch))
+            running.add(task)
+            task.add_done_callback(running.discard)
+        if running:
+            await asyncio.gather(*running)
+        # Nothing reads the queue any more, so whatever is left in it fails
+        # rather than waiting forever
+        while not self._queue.empty():
+            request = self._queue.get_nowait()
+            if request is not None and not request[2].done():
+                request[2].set_exception(RuntimeError("QueryService is closed"))
+
+    async def _execute(self, batch):
+        futures = [future for _, _, future in batch]
+        try:
+            X = np.concatenate([points for points, _, _ in batch])
+            k = max(request_k for _, request_k, _ in batch)
+            self.batches += 1
+            self.batched_points += len(X)
+            distances, ids = await asyncio.get_running_loop().run_in_executor(self.executor, self.tree.query, X, k)
+            start = 0
+            for points, request_k, future in batch:
+                end = start + len(points)
+                # Callers that gave up (cancelled) are skipped
+                if not future.done():
+                    future.set_result((distances[start:end, :request_k], ids[start:end, :request_k]))
+                start = end
+        except Exception as error:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(error)
+        finally:
+            self._slots.release()
+
+
+class InProcessClient:
+
+    # Client for local testing: sends requests straight to a service in the
+    # same event loop and records each request's latency
+
+    def __init__(self, service):
+        self.service = service
+        self.latencies = []  # seconds per request
+
+    async def query(self, X, k=1):
+        start_time = time.perf_counter()
+        try:
+            return await self.service.query(X, k)
+        finally:
+            self.latencies.append(time.perf_counter() - start_time)
+
+    async def run(self, requests, k=1, concurrency=64):
+        # Send every request in requests (arrays of query points) with at
+        # most concurrency in flight, and return the results in order
+        limit = asyncio.Semaphore(concurrency)
+
+        async def _one(X):
+            async with limit:
+                return await self.query(X, k)
+
+        return await asyncio.gather(*(_one(X) for X in requests))
+
+    def summary(self):
+        latencies = np.asarray(self.latencies)
+        if not len(latencies):
+            return {}
+        return {'requests': len(latencies), 'p50': float(np.percentile(latencies, 50)),
+                'p99': float(np.percentile(latencies, 99)), 'max': float(latencies.max())}
+
+
+class _Unbatched:
+
+    # Stand-in service that answers every request on its own in the
+    # executor with the tree's single-point search, the baseline the
+    # micro-batching is compared with
+
+    def __init__(self, tree):
+        self.tree = tree
+
+    def _search(self, X, k):
+        distances = np.full((len(X), k), np.inf)
+        ids = np.full((len(X), k), -1, dtype=np.intp)
+        for row, point in enumerate(X):
+            nearest, _ = self.tree.k_nearest_neighbors(point, k)
+            ids[row, :len(nearest)] = [i for i, _ in nearest]
+            distances[row, :len(nearest)] = [dist for _, dist in nearest]
+        return distances, ids
+
+    async def query(self, X, k=1):
+        return await asyncio.get_running_loop().run_in_executor(None, self._search, X, k)
+
+
+async def _demo(n=100000, d=3, k=10, requests=2000, points_per_request=4, concurrency=64):
+    from kdTree import KDTree
+    rng = np.random.default_rng(0)
+    tree = KDTree(rng.random((n, d)))
+    work = [rng.random((points_per_request, d)) for _ in range(requests)]
+    for name, service in (('unbatched', _Unbatched(tree)), ('batched', QueryService(tree))):
+        if isinstance(service, QueryService):
+            await service.start()
+        client = InProcessClient(service)
+        start_time = time.perf_counter()
+        await client.run(work, k, concurrency)
+        elapsed = time.perf_counter() - start_time
+        summary = client.summary()
+        print(f"{name:>9}: {requests / elapsed:8.0f} requests/s, p50 {summary['p50'] * 1e3:.2f} ms, "
+              f"p99 {summary['p99'] * 1e3:.2f} ms")
+        if isinstance(service, QueryService):
+            await service.close()
+            print(f"           {service.info()}")
+
+if __name__ == "__main__":
+    asyncio.run(_demo())